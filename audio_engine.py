@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import queue
+import threading
+
+from tone import BYTES_PER_SAMPLE, NUM_CHANNELS, SAMPLE_RATE, mix_pcm
+
+# seconds of sound mixed and handed to the output at once
+BLOCK_SECOND = 0.1
+BLOCK_BYTES = round(BLOCK_SECOND * SAMPLE_RATE) * \
+    BYTES_PER_SAMPLE * NUM_CHANNELS
+
+
+class AudioStream(object):
+    '''a sound submitted to the AudioMixer'''
+
+    def __init__(self, pcm):
+        super().__init__()
+        self.pcm = memoryview(pcm).cast('B')
+        self.pos = 0
+        self.cancelled = False
+        self._loop = asyncio.get_running_loop()
+        self._done = self._loop.create_future()
+
+    def cancel(self):
+        '''stop the sound, takes effect from the next block'''
+        self.cancelled = True
+        self._finish()
+
+    def done(self) -> bool:
+        return self._done.done()
+
+    async def wait(self):
+        await asyncio.shield(self._done)
+
+    def _finish(self):
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def _finish_threadsafe(self, delay=0):
+        '''finish delay seconds from now, when the output has played it'''
+        try:
+            self._loop.call_soon_threadsafe(
+                self._loop.call_later, delay, self._finish)
+        except RuntimeError:
+            # loop is closed, nobody is waiting
+            pass
+
+    def _read_block(self):
+        block = self.pcm[self.pos:self.pos+BLOCK_BYTES]
+        self.pos += len(block)
+        if len(block) < BLOCK_BYTES:
+            block = bytes(block) + b'\0' * (BLOCK_BYTES - len(block))
+        return block
+
+
+class AudioMixer(object):
+    '''
+    one thread mixes every playing stream into a single output stream,
+    output.write(pcm) blocks while the output buffer is full, so the
+    output paces the mixing, output.latency is the seconds of sound
+    it buffers before it is heard
+    '''
+
+    def __init__(self, output):
+        super().__init__()
+        self._output = output
+        self._submitted = queue.SimpleQueue()
+        self._streams = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, pcm) -> AudioStream:
+        '''start playing pcm, never blocks the event loop'''
+        stream = AudioStream(pcm)
+        self._submitted.put(stream)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._mix_loop, name='AudioMixer', daemon=True)
+                self._thread.start()
+        return stream
+
+    def _take_submitted(self, block):
+        while True:
+            try:
+                self._streams.append(self._submitted.get(block))
+            except queue.Empty:
+                return
+            block = False
+
+    def _mix_loop(self):
+        while True:
+            if not self._streams:
+                # idle until something is submitted, the output
+                # plays silence meanwhile
+                self._take_submitted(True)
+            self._take_submitted(False)
+            self._streams = [s for s in self._streams if not s.cancelled]
+            if not self._streams:
+                continue
+            blocks = [s._read_block() for s in self._streams]
+            try:
+                self._output.write(mix_pcm(blocks))
+            except BaseException as e:
+                print(f'Audio output failed: {e}')
+            # the last block of these is in the output buffer now
+            for s in self._streams:
+                if s.pos >= len(s.pcm):
+                    s._finish_threadsafe(self._output.latency)
+            self._streams = [s for s in self._streams if s.pos < len(s.pcm)]
@@ -0,0 +1,1173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import copy
+import functools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import clock
+import config
+import sound
+import tcp_dial
+from cmd_processor import dispatch_command, parse_command
+from common import (ByteBuffer, Mode, MsgType, QueueMessage, logger,
+                    phone2modem, support_bps)
+from compression import Compressor
+from fake_conn_server import FakeConnServer, create_server
+from main import ComProtocol
+from modem import Modem
+from path_watcher import watcher
+from speed_limiter import SpeedLimiter
+from timer_wheel import wheel
+
+
+class LegacySpeedLimiter(object):
+    '''the per-millisecond window walk SpeedLimiter used to do, for reference'''
+
+    def __init__(self, window_tmpl, ts):
+        super().__init__()
+        self.ts = ts
+        self.window_tmpl = window_tmpl
+        self.bytes_left = self.window_tmpl.copy()
+
+    def try_reduce_window_at(self, tms, byte_count):
+        ts = int(tms / 1000)
+        if self.ts != ts:
+            self.ts = ts
+            self.bytes_left = self.window_tmpl.copy()
+        ms = tms - ts * 1000
+        self.bytes_left[ms] -= byte_count
+        if self.bytes_left[ms] < 0:
+            left_byte = -self.bytes_left[ms]
+            self.bytes_left[ms] = 0
+            return left_byte
+        return 0
+
+    def reserve(self, tms, byte_count):
+        sleep_to_tms = tms - 1
+        while byte_count > 0:
+            sleep_to_tms += 1
+            byte_count = self.try_reduce_window_at(sleep_to_tms, byte_count)
+        return sleep_to_tms
+
+
+def limiter_workload(bps, chunks=200, seed=0):
+    '''(tms, byte_count) pairs of a guest writing chunks of random size'''
+    rnd = random.Random(seed)
+    tms = 1_600_000_000_000
+    workload = []
+    for _ in range(chunks):
+        byte_count = rnd.choice((1, 16, 512, 4096))
+        workload.append((tms, byte_count))
+        # write again before, on or after the link gets idle
+        tms += rnd.randint(0, byte_count * 8000 // bps * 2)
+    return workload
+
+
+def run_limiter(limiter, workload, wait_idle=False):
+    '''return the send ms of every chunk and the seconds used'''
+    start = time.perf_counter()
+    result = []
+    sleep_to_tms = 0
+    for tms, byte_count in workload:
+        if wait_idle:
+            tms = max(tms, sleep_to_tms + 1)
+        sleep_to_tms = limiter.reserve(tms, byte_count)
+        result.append(sleep_to_tms)
+    return result, time.perf_counter() - start
+
+
+def achieved_bps(workload, result):
+    byte_count = sum(c for _, c in workload)
+    return byte_count * 8000 / (result[-1] + 1 - workload[0][0])
+
+
+def bench_limiter():
+    '''
+    idle: the guest only writes when the link is idle, both limiters
+          must send every chunk on the same ms
+    busy: the guest writes anytime, the legacy limiter forgets bytes
+          reserved in the next second and sends faster than bps
+    '''
+    print(f'{"bps":>6} {"legacy(ms)":>11} {"new(ms)":>8} {"speedup":>8} '
+          f'{"idle same":>9} {"busy legacy bps":>15} {"busy new bps":>12}')
+    for bps in sorted(support_bps):
+        workload = limiter_workload(bps)
+        new = SpeedLimiter(bps)
+        tmpl = new.window_tmpl
+        ts = workload[0][0] // 1000
+        new_idle, _ = run_limiter(copy.deepcopy(new), workload, True)
+        legacy_idle, _ = run_limiter(LegacySpeedLimiter(tmpl, ts), workload, True)
+        same = sum(n == l for n, l in zip(new_idle, legacy_idle))
+        legacy_result, legacy_time = run_limiter(
+            LegacySpeedLimiter(tmpl, ts), workload)
+        new_result, new_time = run_limiter(new, workload)
+        print(f'{bps:>6} {legacy_time*1000:>11.2f} {new_time*1000:>8.2f} '
+              f'{legacy_time/new_time:>7.0f}x {same/len(workload):>9.0%} '
+              f'{achieved_bps(workload, legacy_result):>15.0f} '
+              f'{achieved_bps(workload, new_result):>12.0f}')
+
+
+async def guest_send(m, data):
+    await m.msg_recvq.put(QueueMessage(MsgType.ComData, data))
+
+
+async def guest_expect(m, prefix):
+    while True:
+        data = await m.com_sendq.get()
+        if data.startswith(prefix):
+            return data
+
+
+async def connect_pair(bps, init=None):
+    '''
+    dial, ring and answer between two modems, return both of them,
+    init is sent to both of them first
+    '''
+    caller = Modem(0, '4805698', bps)
+    callee = Modem(1, '7891234', bps)
+    for m in (caller, callee):
+        phone2modem[m.phone] = m
+        m.activate()
+        if init:
+            await guest_send(m, init)
+            await guest_expect(m, b'OK')
+    await guest_send(caller, b'ATDT7891234\r')
+    await guest_expect(callee, b'RING')
+    await guest_send(callee, b'ATA\r')
+    await guest_expect(caller, b'CONNECT')
+    await guest_expect(callee, b'CONNECT')
+    return caller, callee
+
+
+async def virtual_call(bps, byte_count):
+    '''dial, ring, answer and send byte_count bytes between two modems'''
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    caller, callee = await connect_pair(bps)
+    connected = loop.time()
+    for i in range(0, byte_count, 4096):
+        await guest_send(caller, b'x' * min(4096, byte_count - i))
+    received = 0
+    while received < byte_count:
+        received += len(await callee.com_sendq.get())
+    done = loop.time()
+    for m in (caller, callee):
+        m.main_task.cancel()
+    phone2modem.clear()
+    return connected - start, byte_count * 8 / (done - connected)
+
+
+def bench_virtual_time():
+    '''a dial, ring and 100 KB transfer in virtual time'''
+    print(f'{"bps":>6} {"connect(s)":>10} {"achieved bps":>12} {"wall(s)":>8}')
+    for bps in sorted(support_bps):
+        start = time.perf_counter()
+        connect, achieved = clock.run(virtual_call(bps, 100 * 1024), True)
+        wall = time.perf_counter() - start
+        print(f'{bps:>6} {connect:>10.3f} {achieved:>12.0f} {wall:>8.3f}')
+
+
+def fake_sounds(played):
+    '''
+    sleeps as long as the sounds instead of playing them,
+    played collects (start, end) of each, cut short or not
+    '''
+    async def sleep(second):
+        start = clock.now()
+        try:
+            await asyncio.sleep(second)
+        finally:
+            played.append((start, clock.now()))
+
+    async def play_dial_tone(phone):
+        await sleep(sound.DIGIT_IDLE_SECOND +
+                    len(phone) * (sound.DIGIT_SECOND + sound.DIGIT_IDLE_SECOND))
+
+    async def play_ringing_tone():
+        await sleep(sound.RINGING_SECOND)
+
+    async def play_handshake_sound(bps):
+        wv = sound.load_handshake_sound(sound.HANDSHAKE_SOUND_FILE[bps])
+        await sleep(len(wv.pcm) / (wv.num_channels * wv.bytes_per_sample *
+                                   wv.sample_rate))
+    return play_dial_tone, play_ringing_tone, play_handshake_sound
+
+
+async def call_setup(auto_answer, hang_up):
+    '''
+    dial a modem answering on ring auto_answer, the callee hangs up
+    right after CONNECT if hang_up, return the seconds from ATD to
+    CONNECT and to the end of the sounds, and the seconds heard
+    '''
+    played = []
+    caller = Modem(0, '4805698', 33600)
+    callee = Modem(1, '7891234', 33600)
+    for m in (caller, callee):
+        phone2modem[m.phone] = m
+        m.activate()
+    await guest_send(callee, b'ATS0=%d\r' % auto_answer)
+    await guest_expect(callee, b'OK')
+    saved = (sound.play_dial_tone, sound.play_ringing_tone,
+             sound.play_handshake_sound)
+    (sound.play_dial_tone, sound.play_ringing_tone,
+     sound.play_handshake_sound) = fake_sounds(played)
+    try:
+        start = clock.now()
+        await guest_send(caller, b'ATDT7891234\r')
+        await guest_expect(caller, b'CONNECT')
+        connected = clock.now() - start
+        if hang_up:
+            callee.deactivate()
+        # every sound is over by then
+        await asyncio.sleep(60)
+    finally:
+        (sound.play_dial_tone, sound.play_ringing_tone,
+         sound.play_handshake_sound) = saved
+    for m in (caller, callee):
+        m.main_task.cancel()
+    phone2modem.clear()
+    sound_end = max(end for _, end in played) - start
+    return connected, sound_end, sum(end - start for start, end in played)
+
+
+def bench_callsetup():
+    '''
+    ATD to CONNECT at 33600 bps with the sounds awaited or played in
+    the background, in virtual time
+    '''
+    background_sound = config.background_sound
+    print(f'{"sounds":>10} {"S0":>2} {"hang up":>7} {"CONNECT(s)":>10} '
+          f'{"sound end(s)":>12} {"heard(s)":>8}')
+    try:
+        for background in (False, True):
+            config.background_sound = background
+            for auto_answer in (1, 2):
+                for hang_up in (False, True):
+                    connected, sound_end, heard = clock.run(
+                        call_setup(auto_answer, hang_up), True)
+                    name = 'background' if background else 'awaited'
+                    print(f'{name:>10} {auto_answer:>2} {hang_up!s:>7} '
+                          f'{connected:>10.3f} {sound_end:>12.3f} '
+                          f'{heard:>8.3f}')
+    finally:
+        config.background_sound = background_sound
+
+
+async def paced_write(bps, data, init=None):
+    '''
+    one write of data by the calling guest, return the seconds until
+    the first byte reaches the other guest, the largest chunk it gets
+    at once and the bps it gets
+    '''
+    caller, callee = await connect_pair(bps, init)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    byte_count = len(data)
+    await guest_send(caller, data)
+    first = None
+    burst = 0
+    received = 0
+    while received < byte_count:
+        data = await callee.com_sendq.get()
+        if first is None:
+            first = loop.time() - start
+        burst = max(burst, len(data))
+        received += len(data)
+    done = loop.time()
+    for m in (caller, callee):
+        m.main_task.cancel()
+    phone2modem.clear()
+    return first, burst, byte_count * 8 / (done - start)
+
+
+def bench_pacing():
+    '''
+    a 4 KB write in virtual time, delivered as a whole chunk once it
+    is sent, or in slices of config.pacing_slice_ms as a serial line would
+    '''
+    slice_ms = config.pacing_slice_ms or 10
+    print(f'{"bps":>6} {"slice(ms)":>9} {"first byte(s)":>13} '
+          f'{"max burst":>9} {"achieved bps":>12}')
+    try:
+        for bps in sorted(support_bps):
+            for config.pacing_slice_ms in (0, slice_ms):
+                first, burst, achieved = clock.run(
+                    paced_write(bps, b'x' * 4096), True)
+                print(f'{bps:>6} {config.pacing_slice_ms:>9} {first:>13.3f} '
+                      f'{burst:>9} {achieved:>12.0f}')
+    finally:
+        config.pacing_slice_ms = slice_ms
+
+
+def compress_payloads():
+    '''(name, 64 KB of data) like the traffic of a guest'''
+    text = b''
+    for name in sorted(os.listdir('.')):
+        if name.endswith(('.py', '.md')):
+            with open(name, 'rb') as f:
+                text += f.read()
+    random.seed(20)
+    binary = random.randbytes(64 * 1024)
+    return [('text', (text * 2)[:64 * 1024]),
+            ('zlib', zlib.compress(text)[:64 * 1024]),
+            ('binary', binary)]
+
+
+def bench_compress():
+    '''
+    ratio and encoder speed of V.42bis-like compression on 64 KB of
+    data written in 4 KB chunks, and the bps a guest gets sending it
+    in virtual time with AT%C1 at 33600 bps
+    '''
+    print(f'{"payload":>8} {"bytes":>6} {"ratio":>6} {"encode MB/s":>11} '
+          f'{"off bps":>8} {"AT%C1 bps":>9}')
+    bps = 33600
+    for name, data in compress_payloads():
+        compressor = Compressor()
+        start = time.perf_counter()
+        for i in range(0, len(data), 4096):
+            compressor.compress_size(data[i:i + 4096])
+        encode = time.perf_counter() - start
+        _, _, off = clock.run(paced_write(bps, data), True)
+        _, _, on = clock.run(paced_write(bps, data, b'AT%C1\r'), True)
+        print(f'{name:>8} {len(data):>6} {compressor.ratio():>6.2f} '
+              f'{len(data) / encode / 1e6:>11.2f} {off:>8.0f} {on:>9.0f}')
+
+
+def split_lines_bytes(chunks):
+    '''how Modem.handle_at_command used to buffer: bytes += and slicing'''
+    buffer = b''
+    lines = 0
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            ri = buffer.find(b'\r')
+            if ri < 0:
+                break
+            buffer = buffer[ri+1:]
+            lines += 1
+    return lines
+
+
+def split_lines_buffer(chunks):
+    buffer = ByteBuffer()
+    lines = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        while True:
+            ri = buffer.find(b'\r')
+            if ri < 0:
+                break
+            buffer.take(ri + 1)
+            lines += 1
+    return lines
+
+
+def hold_bytes(chunks):
+    '''how Modem buffered data from the remote in CMD mode'''
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+    return len(buffer)
+
+
+def hold_buffer(chunks):
+    buffer = ByteBuffer()
+    for chunk in chunks:
+        buffer.append(chunk)
+    return len(buffer.take())
+
+
+def measure(func, *args):
+    '''return the seconds used and the peak bytes allocated'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    used = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used, peak
+
+
+def bench_buffer():
+    '''
+    cmd: a guest bursts 4096-byte chunks with a \\r every 64 KB in CMD mode
+    hold: the remote sends 1024-byte chunks while the local is in CMD mode
+    '''
+    print(f'{"case":>5} {"MB":>3} {"bytes(s)":>9} {"buffer(s)":>9} '
+          f'{"bytes MB/s":>10} {"buffer MB/s":>11} '
+          f'{"bytes peak":>10} {"buffer peak":>11}')
+    for size in (1, 2, 4):
+        line = b'A' * (64 * 1024 - 1) + b'\r'
+        data = line * (size * 16)
+        cmd_chunks = [data[i:i+4096] for i in range(0, len(data), 4096)]
+        hold_chunks = [b'x' * 1024] * (size * 1024)
+        for case, old, new, chunks in (
+                ('cmd', split_lines_bytes, split_lines_buffer, cmd_chunks),
+                ('hold', hold_bytes, hold_buffer, hold_chunks)):
+            old_time, old_peak = measure(old, chunks)
+            new_time, new_peak = measure(new, chunks)
+            print(f'{case:>5} {size:>3} {old_time:>9.3f} {new_time:>9.3f} '
+                  f'{size/old_time:>10.0f} {size/new_time:>11.0f} '
+                  f'{old_peak/2**20:>9.1f}M {new_peak/2**20:>10.1f}M')
+
+
+async def run_commands(lines, rounds):
+    m = Modem(0, '4805698', 33600)
+    m.activate()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for line in lines:
+            await dispatch_command(m, line)
+    return time.perf_counter() - start
+
+
+def bench_atparse():
+    '''AT command lines parsed and run per second, on an idle modem'''
+    cases = {
+        'single': [b'AT', b'ATE0V1', b'ATS0=1', b'ATS7?', b'ATH'],
+        'chained': [b'ATE0V1S0=1S7=60H', b'AT&FE0V1S11=55S12=50'],
+    }
+    rounds = 2000
+    print(f'{"case":>8} {"lines/s":>9} {"cmds/s":>9}')
+    for case, lines in cases.items():
+        cmd_count = sum(len(list(parse_command(line))) for line in lines)
+        used = asyncio.run(run_commands(lines, rounds))
+        print(f'{case:>8} {len(lines)*rounds/used:>9.0f} '
+              f'{cmd_count*rounds/used:>9.0f}')
+
+
+async def dial_times(pool_size, dns_cache_second, calls):
+    '''ms from ATDT to CONNECT, calling a local TCP service'''
+    async def service(reader, writer):
+        await reader.read()
+        writer.close()
+    server = await asyncio.start_server(service, 'localhost', 0)
+    port = server.sockets[0].getsockname()[1]
+    config.tcp_pool_size = pool_size
+    config.dns_cache_second = dns_cache_second
+    config.tcp_dial_allow = [('localhost', port)]
+    tcp_dial.pools.clear()
+    tcp_dial._dns_cache.clear()
+    m = Modem(0, '4805698', 33600, fast_connect=True)
+    m.activate()
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await dispatch_command(m, f'ATDTlocalhost:{port}'.encode('ascii'))
+        times.append((time.perf_counter() - start) * 1000)
+        await dispatch_command(m, b'ATH')
+        # the guest takes a while before the next call
+        await asyncio.sleep(0.01)
+    tcp_dial.close_pools()
+    await asyncio.sleep(0.01)
+    server.close()
+    return sorted(times)
+
+
+def bench_tcpdial():
+    '''connect time of ATDT host:port, cold and from the pool'''
+    cases = {
+        'cold': (0, 0),
+        'dns_cached': (0, 300),
+        'pooled': (1, 300),
+    }
+    calls = 200
+    print(f'{"case":>10} {"p50 ms":>7} {"p90 ms":>7}')
+    for case, (pool_size, dns_cache_second) in cases.items():
+        times = asyncio.run(dial_times(pool_size, dns_cache_second, calls))
+        print(f'{case:>10} {times[calls//2]:>7.3f} {times[calls*9//10]:>7.3f}')
+
+
+class NullConnection(object):
+    async def push_data(self, cur_modem, data):
+        return
+
+
+async def com_data_seconds(chunk, total):
+    '''seconds Modem.handle_com_data takes for total bytes in DATA mode'''
+    m = Modem(0, '4805698', 33600)
+    m.activate()
+    m.mode = Mode.DATA
+    m.vconn = NullConnection()
+    start = time.perf_counter()
+    for _ in range(total // len(chunk)):
+        await m.handle_com_data(chunk)
+    return time.perf_counter() - start
+
+
+async def timer_seconds(timer_num):
+    '''seconds to add and cancel a guard timer for timer_num modems'''
+    start = time.perf_counter()
+    timers = [wheel.call_later(1, None) for _ in range(timer_num)]
+    for timer in timers:
+        wheel.cancel(timer)
+    return time.perf_counter() - start
+
+
+def bench_escape():
+    '''escape detection cost per byte in DATA mode, by chunk size'''
+    total = 256 * 1024
+    print(f'{"chunk":>6} {"ns/byte":>8} {"MB/s":>7}')
+    for chunk in (b'x', b'+', b'xx', b'x' * 16, b'x' * 256, b'x' * 4096):
+        used = asyncio.run(com_data_seconds(chunk, total))
+        name = repr(chunk) if len(chunk) < 3 else len(chunk)
+        print(f'{name:>6} {used/total*1e9:>8.0f} {total/used/2**20:>7.1f}')
+    timer_num = 10000
+    used = asyncio.run(timer_seconds(timer_num))
+    print(f'timer add+cancel: {timer_num/used:.0f}/s')
+
+
+def traced_call(func, *args):
+    '''return func(*args), the seconds used and the bytes it left allocated'''
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func(*args)
+    used = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return result, used, size
+
+
+async def activate_modems(modems):
+    def activate():
+        for m in modems:
+            m.activate()
+    _, used, size = traced_call(activate)
+    task_num = len(asyncio.all_tasks())
+    for m in modems:
+        m.main_task.cancel()
+    return used, size, task_num
+
+
+async def listen_modems(modems):
+    async def listen():
+        return [await create_server(
+            functools.partial(ComProtocol, m), ('127.0.0.1', 0))
+            for m in modems]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    servers = await listen()
+    used = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    task_num = len(asyncio.all_tasks())
+    for svr in servers:
+        svr.close()
+    return used, size, task_num
+
+
+async def legacy_read_loop(m, reader):
+    '''how COM ports were read before ComProtocol, for reference'''
+    while True:
+        await m.wait_sendable()
+        data = await reader.read(4096)
+        m.stats.com_in_bytes += len(data)
+        logger.info('>%s %r', m.id, data)
+        if not data:
+            return
+        await m.msg_recvq.put(QueueMessage(MsgType.ComData, data))
+
+
+async def com_read(legacy, byte_count):
+    '''
+    byte_count bytes from a guest over TCP into the queue of a modem,
+    return the CPU seconds and the messages it took
+    '''
+    m = Modem(0, '4805698', 33600)
+    activated = asyncio.Event()
+
+    async def legacy_handler(reader, writer):
+        m.activate()
+        activated.set()
+        await legacy_read_loop(m, reader)
+        writer.close()
+
+    if legacy:
+        svr = await asyncio.start_server(legacy_handler, '127.0.0.1', 0)
+    else:
+        svr = await create_server(
+            functools.partial(ComProtocol, m), ('127.0.0.1', 0))
+    reader, writer = await asyncio.open_connection(
+        *svr.sockets[0].getsockname())
+    if not legacy:
+        while not m.activated:
+            await asyncio.sleep(0.001)
+        activated.set()
+    await activated.wait()
+    # the queue is drained here instead of parsed as commands
+    m.main_task.cancel()
+    chunk = b'x' * (64 * 1024)
+    start = time.process_time()
+    sender = asyncio.create_task(guest_write(writer, chunk, byte_count))
+    received = 0
+    messages = 0
+    while received < byte_count:
+        msg = await m.msg_recvq.get()
+        received += len(msg.data)
+        messages += 1
+    used = time.process_time() - start
+    await sender
+    writer.close()
+    svr.close()
+    return used, messages
+
+
+async def guest_write(writer, chunk, byte_count):
+    for _ in range(byte_count // len(chunk)):
+        writer.write(chunk)
+        await writer.drain()
+
+
+def bench_comread():
+    '''32 MB from a guest into the modem queue, with both COM port readers'''
+    byte_count = 32 * 1024 * 1024
+    print(f'{"reader":>14} {"CPU us/KB":>9} {"messages":>8} {"bytes/msg":>9}')
+    for name, legacy in (('StreamReader', True), ('ComProtocol', False)):
+        used, messages = asyncio.run(com_read(legacy, byte_count))
+        print(f'{name:>14} {used / (byte_count / 1024) * 1e6:>9.2f} '
+              f'{messages:>8} {byte_count / messages:>9.0f}')
+
+
+class IdleProtocol(asyncio.Protocol):
+    '''a connection nobody uses, closed with the event loop'''
+
+    async def wait_closed(self):
+        await asyncio.get_running_loop().create_future()
+
+
+async def reattach(down_second):
+    '''
+    a VM socket comes back after down_second, return the seconds until
+    the FakeConnServer is connected again and the connects it tried
+    '''
+    loop = asyncio.get_running_loop()
+    connected = loop.create_future()
+    attempts = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'com.sock')
+
+        async def connect():
+            nonlocal attempts
+            attempts += 1
+            transport, _ = await loop.create_unix_connection(
+                asyncio.Protocol, path)
+            connected.set_result(loop.time())
+            return transport, IdleProtocol()
+
+        fiber = asyncio.create_task(FakeConnServer(connect, path).serve_forever())
+        await asyncio.sleep(down_second)
+        server = await asyncio.start_unix_server(
+            lambda reader, writer: None, path)
+        listening = loop.time()
+        done = await connected
+        fiber.cancel()
+        server.close()
+    return done - listening, attempts
+
+
+def bench_reattach():
+    '''
+    the socket of a VM is gone for a while, then created again,
+    with inotify the modem is woken up at once, without it the
+    jittered backoff decides when it tries again
+    '''
+    if sys.platform == 'win32':
+        print('needs Unix sockets')
+        return
+    print(f'{"down(s)":>7} {"watch":>7} {"reattach(ms)":>12} {"connects":>8}')
+    for down_second in (0.5, 2, 5):
+        for name in ('inotify', 'backoff'):
+            if name == 'backoff':
+                watcher.disable()
+            elif not watcher.enabled:
+                continue
+            latency, attempts = asyncio.run(reattach(down_second))
+            print(f'{down_second:>7} {name:>7} {latency * 1000:>12.1f} '
+                  f'{attempts:>8}')
+        watcher.enable()
+
+
+def bench_modems():
+    '''memory, time and tasks per modem, 10k configured modems'''
+    modem_num = 10000
+    # a real port each, keep below the open file limit
+    listen_num = 1000
+    modems, used, size = traced_call(lambda: [
+        Modem(i, str(1000000 + i), 33600) for i in range(modem_num)])
+    print(f'{"state":>10} {"modems":>6} {"bytes/modem":>11} '
+          f'{"us/modem":>8} {"tasks":>5}')
+    print(f'{"configured":>10} {modem_num:>6} {size/modem_num:>11.0f} '
+          f'{used/modem_num*1e6:>8.2f} {0:>5}')
+    used, size, task_num = asyncio.run(listen_modems(modems[:listen_num]))
+    print(f'{"listening":>10} {listen_num:>6} {size/listen_num:>11.0f} '
+          f'{used/listen_num*1e6:>8.2f} {task_num - 1:>5}')
+    used, size, task_num = asyncio.run(activate_modems(modems[:listen_num]))
+    print(f'{"activated":>10} {listen_num:>6} {size/listen_num:>11.0f} '
+          f'{used/listen_num*1e6:>8.2f} {task_num - 1:>5}')
+
+
+# modem pairs per bps in the end to end benchmark
+E2E_PAIRS_PER_BPS = int(os.environ.get('E2E_PAIRS', 1))
+# seconds of bulk data sent at each bps
+E2E_BULK_SECOND = 2
+E2E_INTERACTIVE_ROUNDS = 20
+E2E_RESULT_FILE = 'log/benchmark-e2e.json'
+# calls of the workers benchmark, each sends this many seconds of data
+WORKERS_PAIRS = int(os.environ.get('WORKERS_PAIRS', 64))
+WORKERS_BULK_SECOND = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def free_ports(count, port=20000):
+    '''
+    count free ports below the ephemeral range, a guest connection can
+    not take one as its local port before a slower shard listens on it
+    '''
+    ports = []
+    while len(ports) < count:
+        with socket.socket() as sock:
+            try:
+                sock.bind(('127.0.0.1', port))
+            except OSError:
+                pass
+            else:
+                ports.append(port)
+        port += 1
+    return ports
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{p}': values[min(len(values) - 1, len(values) * p // 100)]
+            for p in (50, 90, 99)}
+
+
+class Guest(object):
+    '''a synthetic guest driving one modem over its TCP address'''
+
+    def __init__(self, reader, writer):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+
+    async def expect(self, token, timeout=60):
+        '''read until token, return the bytes before it'''
+        deadline = time.perf_counter() + timeout
+        while token not in self.buffer:
+            data = await asyncio.wait_for(
+                self.reader.read(65536), deadline - time.perf_counter())
+            if not data:
+                raise ConnectionError(f'closed while expecting {token!r}')
+            self.buffer += data
+        i = self.buffer.index(token)
+        before = bytes(self.buffer[:i])
+        del self.buffer[:i+len(token)]
+        return before
+
+    async def read_exactly(self, n, timeout=60):
+        deadline = time.perf_counter() + timeout
+        while len(self.buffer) < n:
+            data = await asyncio.wait_for(
+                self.reader.read(65536), deadline - time.perf_counter())
+            if not data:
+                raise ConnectionError(f'closed after {len(self.buffer)} bytes')
+            self.buffer += data
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def command(self, line, result=b'OK\r') -> float:
+        '''send an AT command, return the seconds until its result'''
+        start = time.perf_counter()
+        self.writer.write(line + b'\r')
+        await self.expect(result)
+        return time.perf_counter() - start
+
+
+async def datapath_call(bps, byte_count):
+    '''
+    a guest sends byte_count bytes to another, both modems behind
+    ComProtocols on loopback TCP, return the CPU seconds it took
+    and the seconds the last byte came later than the line allows
+    '''
+    modems = [Modem(0, '4805698', bps, True), Modem(1, '7891234', bps)]
+    servers = []
+    guests = []
+    for m in modems:
+        phone2modem[m.phone] = m
+        svr = await create_server(
+            functools.partial(ComProtocol, m), ('127.0.0.1', 0))
+        servers.append(svr)
+        guests.append(Guest(*await asyncio.open_connection(
+            *svr.sockets[0].getsockname())))
+    caller, callee = guests
+    await callee.command(b'ATS0=1')
+    await caller.command(b'ATDT7891234', b'CONNECT')
+    await caller.expect(b'\r')
+    await callee.expect(b'CONNECT')
+    await callee.expect(b'\r')
+    loop = asyncio.get_running_loop()
+    cpu_start = time.process_time()
+    start = loop.time()
+    caller.writer.write(b'x' * byte_count)
+    await callee.read_exactly(byte_count)
+    late = loop.time() - start - byte_count * 8 / bps
+    cpu = time.process_time() - cpu_start
+    for guest in guests:
+        guest.writer.close()
+    for svr in servers:
+        svr.close()
+    phone2modem.clear()
+    return cpu, late
+
+
+def bench_datapath():
+    '''
+    1 MB between two guests in virtual time, data from the line goes
+    through msg_recvq and the main_loop of the receiving modem (queued),
+    or straight to the guest (direct)
+    '''
+    byte_count = 1024 * 1024
+    deliver = Modem.deliver
+    print(f'{"bps":>6} {"path":>6} {"CPU us/KB":>9} {"late(ms)":>8}')
+    try:
+        for bps in (9600, 56000):
+            for name in ('queued', 'direct'):
+                Modem.deliver = deliver if name == 'direct' else \
+                    lambda self, data: False
+                cpu, late = clock.run(datapath_call(bps, byte_count), True)
+                print(f'{bps:>6} {name:>6} {cpu / (byte_count / 1024) * 1e6:>9.2f} '
+                      f'{late * 1000:>8.1f}')
+    finally:
+        Modem.deliver = deliver
+
+
+async def e2e_pair(bps, caller, callee, phone):
+    '''one call between two guests, return what was measured'''
+    result = {'bps': bps}
+    at_latency = []
+    for g in (caller, callee):
+        at_latency.append(await g.command(b'ATE0V1S0=0'))
+        for _ in range(5):
+            at_latency.append(await g.command(b'AT'))
+    result['at_latency'] = at_latency
+
+    start = time.perf_counter()
+    caller.writer.write(b'ATDT' + phone.encode('ascii') + b'\r')
+    await callee.expect(b'RING\r')
+    await callee.command(b'ATA', f'CONNECT {bps}\r'.encode('ascii'))
+    await caller.expect(f'CONNECT {bps}\r'.encode('ascii'))
+    result['dial_latency'] = time.perf_counter() - start
+
+    byte_count = max(16, round(bps / 8 * E2E_BULK_SECOND))
+    payload = random.Random(bps).randbytes(byte_count)
+    start = time.perf_counter()
+    caller.writer.write(payload)
+    received = await callee.read_exactly(byte_count)
+    used = time.perf_counter() - start
+    result['bulk_bytes'] = byte_count
+    result['bulk_ok'] = received == payload
+    result['achieved_bps'] = byte_count * 8 / used
+    result['accuracy'] = result['achieved_bps'] / bps
+
+    one_way = []
+    for i in range(E2E_INTERACTIVE_ROUNDS):
+        sender, receiver = (caller, callee) if i % 2 == 0 else (callee, caller)
+        start = time.perf_counter()
+        sender.writer.write(b'k')
+        await receiver.read_exactly(1)
+        one_way.append(time.perf_counter() - start)
+    result['interactive_latency'] = one_way
+
+    # escape with the default one second guard time on both sides
+    await asyncio.sleep(1.1)
+    start = time.perf_counter()
+    caller.writer.write(b'+++')
+    await caller.expect(b'OK\r')
+    result['escape_latency'] = time.perf_counter() - start
+    await caller.command(b'ATH')
+    await callee.expect(b'NO CARRIER\r')
+    result['transferred_bytes'] = byte_count + E2E_INTERACTIVE_ROUNDS
+    return result
+
+
+async def wait_listening(address, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(*address)
+            return reader, writer
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def process_cpu_seconds(pid):
+    '''user + system CPU seconds of a running process, None without /proc'''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime, fields 14 and 15 of proc(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def run_e2e(workdir):
+    pairs = []
+    modems = []
+    for bps in sorted(support_bps):
+        for _ in range(E2E_PAIRS_PER_BPS):
+            pair = []
+            for _ in range(2):
+                phone = str(1000 + len(modems))
+                address = ('127.0.0.1', free_port())
+                modems.append({'address': address, 'phone': phone,
+                               'bps': bps, 'fast_connect': True})
+                pair.append((address, phone))
+            pairs.append((bps, pair))
+    config_file = os.path.join(workdir, 'e2e_config.py')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        f.write(f'log_level = logging.ERROR\n'
+                f'log_file = {os.path.join(workdir, "e2e.log")!r}\n'
+                f'capture_file = None\n'
+                f'metrics_address = None\n'
+                f'modems = {modems!r}\n')
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, 'main.py',
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, VMODEM_CONFIG=config_file),
+        stdout=asyncio.subprocess.DEVNULL)
+    try:
+        calls = []
+        for bps, ((caller_addr, _), (callee_addr, callee_phone)) in pairs:
+            caller = Guest(*await wait_listening(caller_addr))
+            callee = Guest(*await wait_listening(callee_addr))
+            calls.append(e2e_pair(bps, caller, callee, callee_phone))
+        cpu_start = process_cpu_seconds(server.pid)
+        start = time.perf_counter()
+        results = await asyncio.gather(*calls)
+        wall = time.perf_counter() - start
+        cpu_end = process_cpu_seconds(server.pid)
+    finally:
+        server.terminate()
+        await server.wait()
+    cpu = cpu_end - cpu_start if cpu_start is not None else None
+    return results, wall, cpu
+
+
+def child_rusage():
+    try:
+        import resource
+    except ImportError:
+        # not on Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def bench_e2e():
+    '''
+    main.py with modem pairs at every bps, driven by synthetic guests,
+    the results are saved as JSON to compare between versions
+    '''
+    before = child_rusage()
+    with tempfile.TemporaryDirectory() as workdir:
+        results, wall, cpu = asyncio.run(run_e2e(workdir))
+    after = child_rusage()
+    transferred = sum(r['transferred_bytes'] for r in results)
+    summary = {
+        'pairs': len(results),
+        'wall_seconds': wall,
+        'transferred_bytes': transferred,
+        'at_latency': percentiles(
+            [t for r in results for t in r['at_latency']]),
+        'dial_latency': percentiles([r['dial_latency'] for r in results]),
+        'interactive_latency': percentiles(
+            [t for r in results for t in r['interactive_latency']]),
+        'escape_latency': percentiles(
+            [r['escape_latency'] for r in results]),
+        'all_bulk_ok': all(r['bulk_ok'] for r in results),
+    }
+    if before and after:
+        if cpu is None:
+            # the whole run, startup included
+            cpu = after.ru_utime + after.ru_stime - \
+                before.ru_utime - before.ru_stime
+        # KB on Linux, bytes on macOS
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        summary['server_max_rss_mb'] = after.ru_maxrss * rss_unit / 2**20
+    if cpu is not None:
+        summary['server_cpu_seconds'] = cpu
+        summary['server_cpu_seconds_per_mb'] = cpu / (transferred / 2**20)
+    rates = []
+    for bps in sorted(support_bps):
+        runs = [r for r in results if r['bps'] == bps]
+        achieved = sum(r['achieved_bps'] for r in runs) / len(runs)
+        rates.append({
+            'bps': bps,
+            'achieved_bps': achieved,
+            'accuracy': achieved / bps,
+            'interactive_latency': percentiles(
+                [t for r in runs for t in r['interactive_latency']]),
+        })
+    report = {'summary': summary, 'rates': rates}
+
+    print(f'{"bps":>6} {"achieved":>9} {"accuracy":>8} {"p50 1B ms":>9}')
+    for rate in rates:
+        print(f'{rate["bps"]:>6} {rate["achieved_bps"]:>9.0f} '
+              f'{rate["accuracy"]:>8.3f} '
+              f'{rate["interactive_latency"]["p50"]*1000:>9.1f}')
+    for key, value in summary.items():
+        print(f'{key}: {value}')
+    os.makedirs(os.path.dirname(E2E_RESULT_FILE), exist_ok=True)
+    with open(E2E_RESULT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print(f'saved to {E2E_RESULT_FILE}')
+
+
+
+async def dial_pair(caller, callee, phone, bps):
+    connect = f'CONNECT {bps}\r'.encode('ascii')
+    await callee.command(b'ATE0V1S0=0')
+    caller.writer.write(b'ATDT' + phone.encode('ascii') + b'\r')
+    await callee.expect(b'RING\r')
+    await callee.command(b'ATA', connect)
+    await caller.expect(connect)
+
+
+async def bulk_pair(caller, callee, payload):
+    caller.writer.write(payload)
+    return await callee.read_exactly(len(payload)) == payload
+
+
+def tree_cpu_seconds(pid):
+    '''CPU seconds of a process and its children, e.g. the shards'''
+    total = process_cpu_seconds(pid)
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        cpu = process_cpu_seconds(child)
+        if total is not None and cpu is not None:
+            total += cpu
+    return total
+
+
+async def run_workers(workdir, workers, pairs, bps):
+    '''
+    main.py with workers shards and pairs calls, each caller on
+    another shard than its callee, return if every byte arrived,
+    the seconds and the CPU seconds of the bulk transfer
+    '''
+    modems = [{'address': ('127.0.0.1', port), 'phone': str(1000 + i),
+               'bps': bps, 'fast_connect': True}
+              for i, port in enumerate(free_ports(pairs * 2))]
+    config_file = os.path.join(workdir, 'workers_config.py')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        f.write(f'log_level = logging.ERROR\n'
+                f'log_file = {os.path.join(workdir, "workers.log")!r}\n'
+                f'capture_file = None\n'
+                f'metrics_address = None\n'
+                f'workers = {workers}\n'
+                f'modems = {modems!r}\n')
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, 'main.py',
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, VMODEM_CONFIG=config_file),
+        stdout=asyncio.subprocess.DEVNULL)
+    try:
+        guests = [Guest(*await wait_listening(m['address'])) for m in modems]
+        calls = [(guests[i], guests[i + 1], modems[i + 1]['phone'])
+                 for i in range(0, len(guests), 2)]
+        await asyncio.gather(*(dial_pair(caller, callee, phone, bps)
+                               for caller, callee, phone in calls))
+        payload = random.Random(bps).randbytes(
+            round(bps / 8 * WORKERS_BULK_SECOND))
+        cpu_start = tree_cpu_seconds(server.pid)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(bulk_pair(caller, callee, payload)
+                                         for caller, callee, _ in calls))
+        wall = time.perf_counter() - start
+        cpu_end = tree_cpu_seconds(server.pid)
+        for guest in guests:
+            guest.writer.close()
+    finally:
+        if server.returncode is None:
+            server.terminate()
+        await server.wait()
+    cpu = cpu_end - cpu_start if cpu_start is not None else None
+    return all(results), wall, cpu
+
+
+def bench_workers():
+    '''
+    aggregate paced throughput of many cross-shard calls at 56000 bps,
+    one process against a shard per CPU, the guests run on the same
+    host, so it only scales with spare cores
+    '''
+    bps = 56000
+    pairs = WORKERS_PAIRS
+    counts = (1, max(2, os.cpu_count() or 1))
+    print(f'{os.cpu_count()} CPUs, {pairs} calls at {bps} bps')
+    print(f'{"workers":>7} {"achieved":>9} {"accuracy":>8} {"CPU s/MB":>8} {"ok":>3}')
+    for workers in counts:
+        with tempfile.TemporaryDirectory() as workdir:
+            ok, wall, cpu = asyncio.run(run_workers(workdir, workers, pairs, bps))
+        sent = round(bps / 8 * WORKERS_BULK_SECOND) * pairs
+        achieved = sent * 8 / wall
+        cpu_mb = f'{cpu / (sent / 2**20):>8.2f}' if cpu is not None else f'{"-":>8}'
+        print(f'{workers:>7} {achieved:>9.0f} {achieved / (bps * pairs):>8.3f} '
+              f'{cpu_mb} {"yes" if ok else "no":>3}')
+
+
+benchmarks = {
+    'limiter': bench_limiter,
+    'virtual_time': bench_virtual_time,
+    'pacing': bench_pacing,
+    'buffer': bench_buffer,
+    'atparse': bench_atparse,
+    'compress': bench_compress,
+    'tcpdial': bench_tcpdial,
+    'escape': bench_escape,
+    'comread': bench_comread,
+    'datapath': bench_datapath,
+    'callsetup': bench_callsetup,
+    'reattach': bench_reattach,
+    'modems': bench_modems,
+    'e2e': bench_e2e,
+    'workers': bench_workers,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        print(f'======  {name}  ======')
+        benchmarks[name]()
+
+
+if __name__ == '__main__':
+    main()
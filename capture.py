@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import mmap
+import queue
+import struct
+import sys
+import threading
+
+import clock
+
+MAGIC = b'VMCAP\x01'
+# timestamp, modem id, direction, payload length
+RECORD_HEADER = struct.Struct('<dIBI')
+
+# data from the guest to the modem
+DIR_IN = 0
+# data from the modem to the guest
+DIR_OUT = 1
+# data the modem sent into the line, as it left the SpeedLimiter
+DIR_LINE = 2
+# the guest opened the COM port, payload: b'phone bps fast_connect'
+DIR_OPEN = 3
+
+ARROWS = {DIR_IN: '>', DIR_OUT: '<', DIR_LINE: '=', DIR_OPEN: '*'}
+
+
+class TrafficCapture(object):
+    '''
+    append raw COM port and line traffic to a binary file,
+    records are written on a background thread
+    '''
+
+    def __init__(self, path):
+        super().__init__()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._write_loop, name='TrafficCapture', daemon=True)
+        self._thread.start()
+
+    def write(self, modem_id, direction, data):
+        self._queue.put((clock.now(), modem_id, direction, data))
+
+    def write_open(self, m):
+        fast_connect = int(bool(m.fast_connect))
+        self.write(m.id, DIR_OPEN,
+                   f'{m.phone} {m.bps} {fast_connect}'.encode('ascii'))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            ts, modem_id, direction, data = record
+            self._file.write(RECORD_HEADER.pack(
+                ts, modem_id, direction, len(data)))
+            self._file.write(data)
+            if self._queue.empty():
+                self._file.flush()
+        self._file.flush()
+
+
+# the TrafficCapture of this process, None when capture is off
+recorder = None
+
+
+def read_capture(path):
+    '''
+    yield (timestamp, modem id, direction, payload) of a capture file,
+    it is memory mapped, so a file still being written can be read
+    up to its last complete record
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = len(MAGIC)
+            end = len(mm)
+            while offset + RECORD_HEADER.size <= end:
+                ts, modem_id, direction, length = \
+                    RECORD_HEADER.unpack_from(mm, offset)
+                offset += RECORD_HEADER.size
+                if offset + length > end:
+                    return
+                yield ts, modem_id, direction, mm[offset:offset + length]
+                offset += length
+
+
+def main():
+    for path in sys.argv[1:]:
+        for ts, modem_id, direction, data in read_capture(path):
+            print(f'{ts:.3f} {ARROWS.get(direction, "?")}{modem_id} {data!r}')
+
+
+if __name__ == '__main__':
+    main()
+
+
+# python capture.py log/traffic.cap
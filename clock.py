@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import selectors
+import time
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+_clock = time.time
+
+
+def now() -> float:
+    '''seconds of the current clock, time.time() unless in virtual time'''
+    return _clock()
+
+
+def set_clock(func):
+    global _clock
+    _clock = func
+
+
+class VirtualTimeSelector(object):
+    '''
+    selector that never blocks while a timer is pending,
+    it jumps the virtual time to the timer instead
+    '''
+
+    def __init__(self, selector, loop):
+        super().__init__()
+        self._selector = selector
+        self._loop = loop
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout is not None and timeout <= 0:
+            return events
+        if timeout is None:
+            # nothing scheduled, wait for I/O or another thread
+            return self._selector.select(None)
+        self._loop.advance_time(timeout)
+        return events
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    '''
+    event loop runs timers as soon as nothing else is ready,
+    asyncio.sleep/wait_for and loop.call_later finish instantly
+    but still in the right order
+    '''
+
+    def __init__(self):
+        # start from zero, float loses sub-ms precision around time.time()
+        self._virtual_time = 0.0
+        super().__init__(VirtualTimeSelector(selectors.DefaultSelector(), self))
+
+    def time(self):
+        return self._virtual_time
+
+    def advance_time(self, second):
+        self._virtual_time += second
+
+
+def run(main, virtual=False, use_uvloop=False):
+    '''
+    asyncio.run, with an optional virtual time event loop,
+    or uvloop if it is installed and use_uvloop
+    '''
+    if not virtual:
+        if use_uvloop and uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return asyncio.run(main)
+    loop = VirtualTimeEventLoop()
+    set_clock(loop.time)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            set_clock(time.time)
+            loop.close()
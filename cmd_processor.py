@@ -1,68 +1,142 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import functools
 
+import clock
+import config
+import metrics
 import sound
+import tcp_dial
+import trunk
 from common import Mode, VConnState, phone2modem
+from link import LinkedConnection, RemoteModem
 from virtual_connection import VirtualConnection
 
+RES_OK = b'OK\r'
+RES_ERROR = b'ERROR\r'
+RES_BUSY = b'BUSY\r'
+RES_NO_ANSWER = b'NO ANSWER\r'
+RES_NO_CARRIER = b'NO CARRIER\r'
 
-async def ATE(modem, cmd) -> bytes:
+
+@functools.lru_cache(maxsize=None)
+def res_connect(bps) -> bytes:
+    return f'CONNECT {bps}\r'.encode('ascii')
+
+
+@functools.lru_cache(maxsize=None)
+def res_carrier(bps) -> bytes:
+    return f'CARRIER {bps}\r'.encode('ascii')
+
+
+# Every command handler takes (modem, arg, info):
+# arg is the bytes following the command letter(s) in the line,
+# info collects informational lines sent before the result code.
+# It returns None to go on with the next command in the line,
+# or the result code which ends the line.
+
+async def ATE(modem, arg, info):
     # support text mode only
-    if cmd == b'ATE0V1':
-        return b'OK'
-    return b'ERROR'
+    if arg in (b'', b'0'):
+        return None
+    return RES_ERROR
 
 
-async def ATS(modem, cmd) -> bytes:
-    expr = list(map(int, cmd[3:].split(b'=')))
-    reg_index = expr[0]
-    if len(expr) == 1:
-        # Load
-        return str(modem.registers[reg_index]).encode('ascii')
-    else:
-        # Store
-        value = expr[1]
-        modem.registers[reg_index] = value
-        return b'OK'
+async def ATV(modem, arg, info):
+    # support verbose result codes only
+    if arg == b'1':
+        return None
+    return RES_ERROR
 
 
-async def ATA(modem, cmd) -> bytes:
+async def ATS(modem, arg, info):
+    try:
+        if arg.endswith(b'?'):
+            # Load
+            reg_index = int(arg[:-1])
+            info.append(f'{modem.registers[reg_index]}\r'.encode('ascii'))
+        elif b'=' in arg:
+            # Store, values out of 0-255 raise ValueError
+            reg_index, value = map(int, arg.split(b'='))
+            modem.registers[reg_index] = value
+        else:
+            # ATSn loads as well
+            reg_index = int(arg)
+            info.append(f'{modem.registers[reg_index]}\r'.encode('ascii'))
+    except (ValueError, IndexError):
+        return RES_ERROR
+    return None
+
+
+async def AT_C(modem, arg, info):
+    # AT%C: data compression, 0 off, 1 MNP5, 2 V.42bis, 3 both,
+    # all of them are simulated as V.42bis
+    if len(arg) > 1 or arg not in b'0123':
+        return RES_ERROR
+    modem.registers[46] = int(arg or b'0')
+    return None
+
+
+async def AT_N(modem, arg, info):
+    # AT\N: error control, 0 normal, 1 direct, 2 MNP reliable,
+    # 3 V.42 auto-reliable, 4 V.42 reliable, 5 MNP auto-reliable,
+    # compression needs 2 or above
+    if len(arg) > 1 or arg not in b'012345':
+        return RES_ERROR
+    modem.registers[48] = int(arg or b'0')
+    return None
+
+
+def answer_call(modem) -> bytes:
     if modem.vconn and modem.vconn.status != VConnState.CLOSED:
         modem.vconn.answer()
         modem.mode = Mode.DATA
-        return f'CONNECT {modem.vconn.bps}'.encode('ascii')
+        metrics.record_connect(modem)
+        return res_connect(modem.vconn.bps)
     else:
         modem.vconn = None
-        return b'BUSY'
+        return RES_BUSY
+
 
+async def ATA(modem, arg, info):
+    return answer_call(modem)
 
-async def ATH(modem, cmd) -> bytes:
+
+async def ATH(modem, arg, info):
     if modem.vconn:
         await modem.vconn.close(modem)
-    return b'OK'
+    # data from the closed line is useless now
+    modem.take_bufferd_send_data()
+    return None
 
 
-async def ATO(modem, cmd) -> bytes:
+async def ATO(modem, arg, info):
     if not modem.vconn:
-        return b'NO CARRIER'
+        return RES_NO_CARRIER
     modem.mode = Mode.DATA
-    return f'CARRIER {modem.vconn.bps}'.encode('ascii')
+    return res_carrier(modem.vconn.bps)
 
 
-async def ATZ(modem, cmd) -> bytes:
+async def ATZ(modem, arg, info):
     if modem.vconn:
         await modem.vconn.close(modem)
+    modem.take_bufferd_send_data()
     modem.mode = Mode.CMD
     modem.clear_registers()
-    return b'OK'
+    return None
+
+
+async def AT_F(modem, arg, info):
+    # AT&F: factory defaults
+    modem.clear_registers()
+    return None
 
 
 def build_vconn(from_m, to_phone):
-    # find remote modem
-    try:
-        to_m = phone2modem[to_phone]
-    except KeyError:
+    # find remote modem, here or on a peer
+    to_m = phone2modem.get(to_phone) or trunk.route_phone(to_phone)
+    if to_m is None:
         raise ValueError(f'unkown phone {to_phone}')
     # cant call yourself
     if from_m.id == to_m.id:
@@ -73,62 +147,166 @@ def build_vconn(from_m, to_phone):
     if from_m.vconn or to_m.vconn:
         raise RuntimeError('modem is busy line')
     # create virtual connection
-    from_m.vconn = VirtualConnection(from_m, to_m)
+    if isinstance(to_m, RemoteModem):
+        # the process serving to_m checks it again when it rings
+        from_m.vconn = LinkedConnection(from_m, to_m)
+    else:
+        from_m.vconn = VirtualConnection(from_m, to_m)
+        # S1: ring count of the incoming call
+        to_m.registers[1] = 0
     to_m.vconn = from_m.vconn
     return from_m.vconn
 
 
 def cancel_vconn(vconn):
+    vconn.set_closed()
     for m in vconn.modems:
         m.vconn = None
 
 
-async def ATD(modem, cmd) -> bytes:
-    phone_number = cmd[4:].decode('ascii')
-    await sound.play_dial_tone(phone_number)
+async def dial_tcp(modem, phone_number, endpoint, dial_start) -> bytes:
+    if modem.vconn:
+        print(f'{modem.id}|Dial to {phone_number} failed: modem is busy line')
+        return RES_BUSY
+    if not tcp_dial.dial_allowed(phone_number, endpoint):
+        # the guest could reach any host this machine can otherwise
+        print(f'{modem.id}|Dial to {phone_number} failed: '
+              f'not in tcp_dial_allow')
+        return RES_NO_CARRIER
+    sounds = sound.CallSound(config.background_sound)
+    if not modem.fast_connect and phone_number in config.dial_aliases:
+        await sounds.play(sound.play_dial_tone, phone_number)
+    try:
+        vconn = await tcp_dial.connect(modem, endpoint)
+    except TimeoutError as e:
+        sounds.cancel()
+        print(f'{modem.id}|Dial to {phone_number} failed: {e}')
+        return RES_NO_CARRIER
+    except OSError as e:
+        sounds.cancel()
+        print(f'{modem.id}|Dial to {phone_number} failed: {e}')
+        return RES_NO_ANSWER
+    if modem.vconn:
+        # called by another modem meanwhile
+        vconn.set_closed()
+        sounds.cancel()
+        print(f'{modem.id}|Dial to {phone_number} failed: modem is busy line')
+        return RES_BUSY
+    modem.vconn = vconn
+    sounds.stop_on(vconn.closed)
+    if not modem.fast_connect:
+        await sounds.play(sound.play_handshake_sound, vconn.bps)
+    print(f'{modem.id}|Dial to {phone_number} success: {vconn.bps}bps')
+    modem.mode = Mode.DATA
+    metrics.record_connect(modem, clock.now() - dial_start)
+    return res_connect(vconn.bps)
+
+
+async def ATD(modem, arg, info):
+    dial_start = clock.now()
+    # P for 'Pulse dial', T for 'Tone dial'
+    if arg[:1] in (b'P', b'T'):
+        arg = arg[1:]
+    phone_number = arg.decode('ascii')
+    # ATDT host:port, or a number in config.dial_aliases
+    endpoint = tcp_dial.parse_endpoint(phone_number)
+    if endpoint:
+        return await dial_tcp(modem, phone_number, endpoint, dial_start)
+    sounds = sound.CallSound(config.background_sound)
+    if not modem.fast_connect:
+        await sounds.play(sound.play_dial_tone, phone_number)
     try:
         vconn = build_vconn(modem, phone_number)
     except BaseException as e:
+        sounds.cancel()
         print(f'{modem.id}|Dial to {phone_number} failed: {e}')
-        return b'BUSY'
+        return RES_BUSY
+    # silent once the call fails or is hung up
+    sounds.stop_on(vconn.closed)
 
     try:
-        ok = await vconn.dial(modem)
+        ok = await vconn.dial(modem, sounds)
     except TimeoutError:
         cancel_vconn(vconn)
         print(f'{modem.id}|Dial to {phone_number} failed: timeout')
-        return b'NO ANSWER'
+        return RES_NO_ANSWER
     if not ok:
         cancel_vconn(vconn)
         print(f'{modem.id}|Dial to {phone_number} failed: refused by remote')
-        return b'BUSY'
+        return RES_BUSY
 
-    await sound.play_handshake_sound(vconn.bps)
+    if not modem.fast_connect:
+        # answered, the rest of the ringing is not heard
+        sounds.cancel(sound.play_ringing_tone)
+        await sounds.play(sound.play_handshake_sound, vconn.bps)
     print(f'{modem.id}|Dial to {phone_number} success: {modem.vconn.bps}bps')
     modem.mode = Mode.DATA
-    return f'CONNECT {modem.vconn.bps}'.encode('ascii')
+    metrics.record_connect(modem, clock.now() - dial_start)
+    return res_connect(modem.vconn.bps)
 
 
-cmd2func = [
-    (b'ATE', ATE),
-    (b'ATS', ATS),
-    (b'ATA', ATA),
-    (b'ATH', ATH),
-    (b'ATO', ATO),
-    (b'ATZ', ATZ),
-    # P for 'Pulse dial', T for 'Tone dial'
-    (b'ATDP', ATD),
-    (b'ATDT', ATD),
-]
+cmd_table = {
+    b'E': ATE,
+    b'V': ATV,
+    b'S': ATS,
+    b'A': ATA,
+    b'H': ATH,
+    b'O': ATO,
+    b'Z': ATZ,
+    b'D': ATD,
+    b'&F': AT_F,
+    b'%C': AT_C,
+    b'\\N': AT_N,
+}
+# first byte of commands named with two bytes, like &F
+CMD_PREFIXES = frozenset(b'&%\\')
+DIGITS = frozenset(b'0123456789')
+S_ARG_BYTES = frozenset(b'0123456789=?')
 
 
-async def dispatch_command(modem, cmd) -> bytes:
-    global cmd2func
-    for prefix, func in cmd2func:
-        if cmd.startswith(prefix):
-            return await func(modem, cmd) + b'\r'
+def parse_command(cmd):
+    '''
+    split the line after AT into (name, arg) pairs in one pass,
+    e.g. b'ATE0V1S0=1X4' -> (b'E', b'0'), (b'V', b'1'), (b'S', b'0=1'), (b'X', b'4')
+    '''
+    i = 2
+    end = len(cmd)
+    while i < end:
+        c = cmd[i]
+        if c == 0x20:
+            i += 1
+            continue
+        start = i
+        i += 2 if c in CMD_PREFIXES else 1
+        name = cmd[start:i]
+        arg_start = i
+        if name == b'D':
+            # the dial string takes the rest of the line
+            i = end
+        else:
+            arg_bytes = S_ARG_BYTES if name == b'S' else DIGITS
+            while i < end and cmd[i] in arg_bytes:
+                i += 1
+        yield name, cmd[arg_start:i]
 
-    if cmd != b'AT':
+
+async def dispatch_command(modem, cmd) -> bytes:
+    cmd = cmd.upper()
+    if not cmd.startswith(b'AT'):
         # Unknown command
         print(f'{modem.id}|Unknown cmd:{cmd!r}')
-    return b'OK\r'
+        return RES_OK
+    info = []
+    res = None
+    for name, arg in parse_command(cmd):
+        func = cmd_table.get(name)
+        if func is None:
+            # unsupported settings in init strings are ignored
+            print(f'{modem.id}|Unknown cmd:{name!r}{arg!r} in {cmd!r}')
+            continue
+        res = await func(modem, arg, info)
+        if res is not None:
+            break
+    if info:
+        return b''.join(info) + (res or RES_OK)
+    return res or RES_OK
@@ -1,24 +1,73 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 import asyncio
+import atexit
 import contextvars
 import functools
 import logging
 import logging.handlers
+import os
+import queue
 from collections import namedtuple
 from enum import Enum
 
 import config
 
-fileHandler = logging.handlers.RotatingFileHandler(
-    'log/network.log', encoding='utf-8', maxBytes=16*1024*1024, backupCount=9)
-fileHandler.setLevel(config.log_level)
-fileHandler.setFormatter(logging.Formatter(
-    u'%(asctime)s|%(levelname)s|%(filename)s|%(lineno)3d:%(message)s'))
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    '''
+    hand records to the listener thread unformatted, the message is only
+    built there, safe as long as log arguments are immutable (bytes, int)
+    '''
+
+    def prepare(self, record):
+        return record
+
+
+# disk writes and formatting happen on the listener thread, not the loop
+queueHandler = LazyQueueHandler(queue.SimpleQueue())
+logListener = None
 
 logger = logging.getLogger('logger')
 logger.setLevel(config.log_level)
-logger.addHandler(fileHandler)
+logger.addHandler(queueHandler)
+
+
+def start_logging(filename):
+    '''
+    (re)start the listener thread writing the log to filename,
+    a forked child process must call it to get a listener of its own
+    '''
+    global logListener
+    stop_logging()
+    queueHandler.queue = queue.SimpleQueue()
+    fileHandler = logging.handlers.RotatingFileHandler(
+        filename, encoding='utf-8', maxBytes=16*1024*1024, backupCount=9)
+    fileHandler.setLevel(config.log_level)
+    fileHandler.setFormatter(logging.Formatter(
+        u'%(asctime)s|%(levelname)s|%(filename)s|%(lineno)3d:%(message)s'))
+    logListener = logging.handlers.QueueListener(
+        queueHandler.queue, fileHandler, respect_handler_level=True)
+    logListener.start()
+
+
+def stop_logging():
+    global logListener
+    if logListener:
+        logListener.stop()
+        for handler in logListener.handlers:
+            handler.close()
+        logListener = None
+
+
+start_logging(config.log_file)
+atexit.register(stop_logging)
+
+
+def shard_path(path, shard):
+    '''log/network.log -> log/network-shard1.log'''
+    root, ext = os.path.splitext(path)
+    return f'{root}-shard{shard}{ext}'
 
 
 class Mode(Enum):
@@ -66,6 +115,93 @@ support_bps = {
 }
 
 
+class ByteBuffer(object):
+    '''
+    growable byte buffer, appending to the tail and consuming from the head
+    are amortized O(1) instead of copying the whole buffer like bytes +=
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._buf = bytearray()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def append(self, data):
+        self._buf += data
+
+    def find(self, sub) -> int:
+        return self._buf.find(sub)
+
+    def peek(self) -> bytes:
+        return bytes(self._buf)
+
+    def take(self, n=None) -> bytes:
+        '''remove and return the first n bytes, or all of them'''
+        if n is None or n >= len(self._buf):
+            data = bytes(self._buf)
+            self._buf.clear()
+            return data
+        with memoryview(self._buf) as view:
+            data = bytes(view[:n])
+        # bytearray moves its start instead of the bytes left
+        del self._buf[:n]
+        return data
+
+    def clear(self):
+        self._buf.clear()
+
+
+class FlowControlQueue(asyncio.Queue):
+    '''
+    queue counts the data bytes it holds, once they reach high_water
+    put() waits until get() drains them to low_water, like RTS/CTS;
+    high_water is not a hard bound: put_nowait() never waits, and put()
+    only waits once it is reached, so the bytes admitted before that,
+    e.g. the rest of a chunk read before the queue filled, go past it
+    '''
+
+    def __init__(self, high_water, low_water):
+        super().__init__()
+        self.high_water = high_water
+        self.low_water = low_water
+        self.nbytes = 0
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @staticmethod
+    def _item_bytes(item):
+        if isinstance(item, QueueMessage):
+            item = item.data
+        if isinstance(item, (bytes, bytearray)):
+            return len(item)
+        return 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.nbytes += self._item_bytes(item)
+        if self.nbytes >= self.high_water:
+            self._writable.clear()
+
+    def _get(self):
+        item = super()._get()
+        self.nbytes -= self._item_bytes(item)
+        if self.nbytes <= self.low_water:
+            self._writable.set()
+        return item
+
+    def writable(self) -> bool:
+        return self._writable.is_set()
+
+    async def wait_writable(self):
+        await self._writable.wait()
+
+    async def put(self, item):
+        await self._writable.wait()
+        self.put_nowait(item)
+
+
 def clear_queue(q: asyncio.Queue):
     while True:
         try:
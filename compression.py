@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# V.42bis: codewords 0-2 are control codes, 3-258 the characters,
+# strings get the codewords from 259 up to the dictionary size
+FIRST_CHAR_CODE = 3
+FIRST_STRING_CODE = 259
+MIN_CODE_BITS = 9
+# N2: dictionary size, N7: longest string
+DICT_SIZE = 2048
+MAX_STRING = 32
+
+
+class Compressor(object):
+    '''
+    a V.42bis-like streaming LZW encoder of one direction of a call,
+    it only counts the bits it would send, the data itself goes to
+    the remote unchanged
+    '''
+
+    def __init__(self, dict_size=DICT_SIZE, max_string=MAX_STRING):
+        super().__init__()
+        self.dict_size = dict_size
+        self.max_string = max_string
+        self.max_code_bits = (dict_size - 1).bit_length()
+        # bytes taken from the guest, bytes charged to the line
+        self.raw_bytes = 0
+        self.line_bytes = 0
+        # codeword of the string matched so far, and its length
+        self._code = None
+        self._length = 0
+        # bits sent but not yet charged as a whole byte
+        self._carry_bits = 0
+        self._reset_dict()
+
+    def _reset_dict(self):
+        # (codeword << 8 | next byte): codeword of the longer string
+        self._table = {}
+        self._next_code = FIRST_STRING_CODE
+        self._code_bits = MIN_CODE_BITS
+
+    def ratio(self) -> float:
+        '''raw bytes per byte on the line'''
+        return self.raw_bytes / self.line_bytes if self.line_bytes else 1
+
+    def _encode(self, data) -> int:
+        '''update the dictionary with data, return the bits of codewords sent'''
+        table = self._table
+        code = self._code
+        length = self._length
+        max_string = self.max_string
+        bits = 0
+        for byte in data:
+            if code is None:
+                code = byte + FIRST_CHAR_CODE
+                length = 1
+                continue
+            key = code << 8 | byte
+            longer = table.get(key)
+            if longer is not None and length < max_string:
+                code = longer
+                length += 1
+                continue
+            bits += self._code_bits
+            if longer is None:
+                if self._next_code < self.dict_size:
+                    table[key] = self._next_code
+                    self._next_code += 1
+                    # STEPUP: the next codeword needs one more bit
+                    if self._next_code > 1 << self._code_bits and \
+                            self._code_bits < self.max_code_bits:
+                        self._code_bits += 1
+                else:
+                    # V.42bis recycles old leaves, starting over is close
+                    self._reset_dict()
+                    table = self._table
+            code = byte + FIRST_CHAR_CODE
+            length = 1
+        self._code = code
+        self._length = length
+        return bits
+
+    def compress_size(self, data, flush=True) -> int:
+        '''
+        bytes the line takes for data, flush sends the string matched
+        so far and pads to a byte, as V.42bis does once the guest stops
+        sending; data that does not compress goes in transparent mode
+        '''
+        bits = self._encode(data)
+        if flush and self._code is not None:
+            bits += self._code_bits
+            self._code = None
+        bits = min(bits, len(data) * 8)
+        carry = self._carry_bits + bits
+        if flush:
+            byte_count = (carry + 7) // 8
+            carry = 0
+        else:
+            byte_count, carry = divmod(carry, 8)
+        self._carry_bits = carry
+        self.raw_bytes += len(data)
+        self.line_bytes += byte_count
+        return byte_count
+
+
+def capable(m) -> bool:
+    '''if modem m has compression and error control on'''
+    registers = getattr(m, 'registers', None)
+    if registers is None:
+        # served by another process or host, its settings came with
+        # the DIAL or ANSWER frame of the call
+        return m.compression
+    # S46: AT%C, data compression; S48: AT\N, error control,
+    # V.42bis only runs on an error corrected link
+    return bool(registers[46]) and registers[48] >= 2
+
+
+def negotiate(modems) -> bool:
+    '''whether a call between modems is compressed, all must be capable'''
+    return all(capable(m) for m in modems)
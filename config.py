@@ -1,7 +1,78 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 
 log_level = logging.DEBUG
+log_file = 'log/network.log'
+
+# run timers in virtual time, for scripted guests only:
+# sleeps finish instantly, so real guests will see timeouts
+virtual_time = False
+
+# run on uvloop when it is installed (pip install uvloop, not on Windows)
+use_uvloop = True
+
+# serve the modems in this many processes, modem i goes to process
+# i % workers, calls between processes go over socketpairs
+workers = 1
+
+# write all chunks ready for the COM port at once, up to this many bytes
+com_write_batch_bytes = 64 * 1024
+# seconds to wait for more chunks before a write, 0 to write at once
+com_write_flush_delay = 0
+
+# play the dial, ringing and handshake sounds in the background, so
+# RING and CONNECT come as soon as the call gets there instead of
+# after the sounds, which stop once the call is answered or hung up
+background_sound = False
+
+# the line delivers a chunk in slices of this many ms of data, each
+# once it is sent, like a serial line; 0 delivers the whole chunk
+# once its last byte is sent
+pacing_slice_ms = 10
+
+# bytes a modem queue or CMD mode buffer may hold before the sender
+# stops reading its COM port, it reads again once they drop to low water
+queue_high_water = 64 * 1024
+queue_low_water = 16 * 1024
+
+# serve metrics on http://host:port/metrics (Prometheus) and
+# /metrics.json, None to disable, shard n listens on port + n
+metrics_address = None  # e.g. ('127.0.0.1', 9100)
+
+# append raw COM port and line traffic to this binary file, None to
+# disable, print it with: python capture.py log/traffic.cap
+# replay it with: python replay.py log/traffic.cap
+capture_file = None
+
+# trunks to other VirtualModem instances, so modems on other hosts
+# can be dialed, calls to a number go to the peer with the longest
+# matching prefix, trunk_listen accepts calls from the peers,
+# connections from any other address are refused
+trunk_listen = None  # e.g. ('192.168.1.1', 7001)
+trunk_peers = [
+    # {'address': ('192.168.1.2', 7001), 'prefixes': ['48']},
+]
+
+# ATDT host:port dials a TCP service like a telnet BBS,
+# so do the numbers here, e.g. ATDT5551234
+dial_aliases = {
+    # '5551234': ('bbs.example.com', 23),
+}
+# host:port that ATDT may dial besides the aliases, none by default,
+# a '*' host allows any host on that port
+tcp_dial_allow = [
+    # ('bbs.example.com', 23),
+]
+# seconds to wait for a TCP service to accept a call
+tcp_connect_timeout_second = 10
+# connections opened ahead of the calls per TCP endpoint dialed,
+# 0 to disable, they stay open to the service while they wait
+tcp_pool_size = 0
+# seconds a connection may wait in the pool before it is closed
+tcp_pool_idle_second = 60
+# seconds host names stay resolved
+dns_cache_second = 300
 
 modems = [
     {
@@ -15,3 +86,9 @@ modems = [
         'bps': 33600,
     },
 ]
+
+# settings of this host on top of the ones above, e.g. to run
+# a second instance on one machine: VMODEM_CONFIG=host2.py python main.py
+if os.environ.get('VMODEM_CONFIG'):
+    with open(os.environ['VMODEM_CONFIG'], encoding='utf-8') as f:
+        exec(f.read())
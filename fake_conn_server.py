@@ -1,41 +1,73 @@
 import asyncio
 import functools
+import random
 import sys
 
+from path_watcher import watcher
+
+# seconds between connect attempts, doubled after each failure,
+# an attempt is made at once when the socket path is created
+RETRY_MIN_SECOND = 0.05
+RETRY_MAX_SECOND = 3
+# paths watched by inotify wake up the retry, so it can wait longer
+WATCHED_RETRY_MAX_SECOND = 30
+
+
+def retry_delay(retry, max_second) -> float:
+    '''exponential backoff with jitter, so the modems dont retry together'''
+    delay = min(max_second, RETRY_MIN_SECOND * 2 ** min(retry, 16))
+    return random.uniform(delay / 2, delay)
+
 
 class FakeConnServer(object):
+    '''
+    connects to a port that listens itself, like the serial socket
+    or named pipe of a VM, and serves one connection at a time
+    '''
 
-    def __init__(self, handler, conn_func):
+    def __init__(self, conn_func, path):
         super().__init__()
-        self._handler = handler
         self._conn_func = conn_func
+        self._path = path
 
     async def serve_forever(self):
+        retry = 0
+        failing = False
         while True:
             try:
-                reader, writer = await self._conn_func()
-            except FileNotFoundError:
-                await asyncio.sleep(3)
+                transport, protocol = await self._conn_func()
+            except OSError as e:
+                if not failing:
+                    print(f'Cant connect {self._path}: {e}, retrying')
+                    failing = True
+                max_second = WATCHED_RETRY_MAX_SECOND if watcher.enabled \
+                    else RETRY_MAX_SECOND
+                created = await watcher.wait(
+                    self._path, retry_delay(retry, max_second),
+                    isinstance(e, FileNotFoundError))
+                # a new socket may still refuse until it listens,
+                # start over from the shortest delay
+                retry = 0 if created else retry + 1
                 continue
-            await self._handler(reader, writer)
+            retry = 0
+            failing = False
+            await protocol.wait_closed()
 
 
-async def create_server(handler, address):
+async def create_server(protocol_factory, address):
+    '''
+    serve a port with protocol_factory, a protocol with wait_closed(),
+    a TCP address gets an asyncio server, a path a FakeConnServer
+    '''
+    loop = asyncio.get_running_loop()
     if isinstance(address, (tuple, list)):
-        return await asyncio.start_server(handler, *address)
+        return await loop.create_server(protocol_factory, *address)
     elif isinstance(address, str):
         if sys.platform != "win32":
-            return FakeConnServer(handler, functools.partial(asyncio.open_unix_connection, address))
-        return FakeConnServer(handler, functools.partial(open_namedpipe_connection, address))
+            return FakeConnServer(functools.partial(
+                loop.create_unix_connection, protocol_factory, address),
+                address)
+        return FakeConnServer(functools.partial(
+            loop.create_pipe_connection, protocol_factory, address), address)
     else:
         raise TypeError(f"Invalid address {address}")
-
-
-async def open_namedpipe_connection(path=None, *, limit=2**16):
-    loop = asyncio.events.get_running_loop()
-
-    reader = asyncio.streams.StreamReader(limit=limit, loop=loop)
-    protocol = asyncio.streams.StreamReaderProtocol(reader, loop=loop)
-    transport, _ = await loop.create_pipe_connection(lambda: protocol, path)
-    writer = asyncio.streams.StreamWriter(transport, protocol, reader, loop)
-    return reader, writer
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import struct
+from enum import Enum
+
+import clock
+import compression
+from common import (MsgType, QueueMessage, VConnEventType, VConnState, logger,
+                    phone2modem)
+from speed_limiter import SpeedLimiter
+from virtual_connection import VirtualConnection
+
+# kind, caller phone length, callee phone length, payload length
+FRAME_HEADER = struct.Struct('<BBBI')
+BPS = struct.Struct('<I')
+# bps, 1 if the modem has compression on
+CALL_INFO = struct.Struct('<IB')
+# send time of a PING, echoed back in the PONG
+TIMESTAMP = struct.Struct('<d')
+
+
+class FrameType(Enum):
+    # payload: CALL_INFO of the caller
+    DIAL = 0
+    # payload: CALL_INFO of the connection and the callee
+    ANSWER = 1
+    REFUSE = 2
+    DATA = 3
+    HANG = 4
+    # the caller gave up before the call was answered
+    CANCEL = 5
+    # payload: TIMESTAMP, not part of a call
+    PING = 6
+    PONG = 7
+    # the receiver of a call has no room, stop sending DATA until RESUME
+    PAUSE = 8
+    RESUME = 9
+
+
+# the shortest payload of the frames that have one
+MIN_PAYLOAD = {
+    FrameType.DIAL: BPS.size,
+    FrameType.ANSWER: BPS.size,
+    FrameType.PING: TIMESTAMP.size,
+    FrameType.PONG: TIMESTAMP.size,
+}
+
+
+def unpack_call_info(payload):
+    '''(bps, compression) of a CALL_INFO, a peer without it sends BPS'''
+    if len(payload) < CALL_INFO.size:
+        bps, capable = BPS.unpack_from(payload)[0], False
+    else:
+        bps, capable = CALL_INFO.unpack_from(payload)
+    if not bps:
+        raise ValueError('call with 0 bps')
+    return bps, bool(capable)
+
+
+def decode_frame(kind, body, src_len, dst_len):
+    '''
+    (kind, src, dst, payload) of a frame, ValueError if it is malformed,
+    e.g. an unknown kind, a phone not in ascii or a payload too short
+    '''
+    kind = FrameType(kind)
+    src = body[:src_len].decode('ascii')
+    dst = body[src_len:src_len+dst_len].decode('ascii')
+    payload = body[src_len+dst_len:]
+    if len(payload) < MIN_PAYLOAD.get(kind, 0):
+        raise ValueError(f'{kind.name} payload of {len(payload)} bytes')
+    return kind, src, dst, payload
+
+
+class Link(object):
+    '''
+    frames of every call between this process and a peer,
+    carried over one stream, e.g. a socketpair to another shard
+    '''
+
+    def __init__(self, name, reader, writer):
+        super().__init__()
+        self.name = name
+        self._reader = reader
+        self._writer = writer
+        self.closed = False
+        # round trip time in seconds, None until the first PONG
+        self.rtt = None
+        # when a frame came in last
+        self.last_heard = clock.now()
+
+    def latency(self) -> float:
+        '''one way latency in seconds'''
+        return self.rtt / 2 if self.rtt else 0
+
+    def send(self, kind, src='', dst='', payload=b''):
+        if self.closed:
+            return
+        src = src.encode('ascii')
+        dst = dst.encode('ascii')
+        self._writer.writelines((
+            FRAME_HEADER.pack(kind.value, len(src), len(dst), len(payload)),
+            src, dst, payload))
+
+    def ping(self):
+        self.send(FrameType.PING, payload=TIMESTAMP.pack(clock.now()))
+
+    async def drain(self):
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            # serve_forever hangs up the calls
+            pass
+
+    def close(self):
+        self._writer.close()
+
+    async def serve_forever(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(FRAME_HEADER.size)
+                kind, src_len, dst_len, length = FRAME_HEADER.unpack(header)
+                body = await self._reader.readexactly(
+                    src_len + dst_len + length)
+                self.last_heard = clock.now()
+                self.handle_frame(*decode_frame(kind, body, src_len, dst_len))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f'Link {self.name} closed: {e!r}')
+        except (ValueError, struct.error) as e:
+            # the peer is broken or not a VirtualModem, dont trust the rest
+            print(f'Link {self.name} protocol error: {e!r}')
+        finally:
+            self.closed = True
+            self._writer.close()
+            self.hang_up_calls()
+
+    def hang_up_calls(self):
+        '''the link is gone, end every call carried by it'''
+        for m in list(phone2modem.values()):
+            vconn = m.vconn
+            if isinstance(m, RemoteModem) or \
+                    not isinstance(vconn, LinkedConnection) or \
+                    vconn.remote_modem.link is not self:
+                continue
+            if vconn.status == VConnState.CONNECTING:
+                self._cancel(m, vconn)
+            elif vconn.status == VConnState.CONNECTED:
+                self._hang_up(m, vconn)
+
+    def _find_call(self, src, dst):
+        '''the local modem and its connection for a call from src to dst'''
+        m = phone2modem.get(dst)
+        if m is None or isinstance(m, RemoteModem):
+            return None, None
+        vconn = m.vconn
+        if not isinstance(vconn, LinkedConnection) or \
+                vconn.remote_modem.phone != src or \
+                vconn.remote_modem.link is not self:
+            return m, None
+        return m, vconn
+
+    def _hang_up(self, m, vconn):
+        VirtualConnection.set_closed(vconn)
+        vconn.remote_modem.vconn = None
+        m.msg_recvq.put_nowait(
+            QueueMessage(MsgType.VConnEvent, VConnEventType.HANG))
+
+    def _cancel(self, m, vconn):
+        VirtualConnection.set_closed(vconn)
+        # stop ringing if it is the caller giving up
+        vconn.dial_answered.set()
+        vconn.remote_modem.vconn = None
+        m.vconn = None
+
+    def _pause(self, m, vconn):
+        '''
+        stop the sender of the call until m has room, the frames
+        already on the way are queued, other calls go on
+        '''
+        if vconn.pausing:
+            return
+        vconn.pausing = True
+        self.send(FrameType.PAUSE, m.phone, vconn.remote_modem.phone)
+        asyncio.create_task(self._resume_when_receivable(m, vconn))
+
+    async def _resume_when_receivable(self, m, vconn):
+        waiters = {asyncio.ensure_future(m.wait_receivable()),
+                   asyncio.ensure_future(vconn.closed.wait())}
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waiters:
+                w.cancel()
+        vconn.pausing = False
+        if not vconn.closed.is_set():
+            self.send(FrameType.RESUME, m.phone, vconn.remote_modem.phone)
+
+    def handle_frame(self, kind, src, dst, payload):
+        '''handles a frame at once, the reader never waits for a call'''
+        if kind == FrameType.DIAL:
+            self.handle_dial(src, dst, *unpack_call_info(payload))
+            return
+        if kind == FrameType.PING:
+            self.send(FrameType.PONG, payload=payload)
+            return
+        if kind == FrameType.PONG:
+            sample = clock.now() - TIMESTAMP.unpack_from(payload)[0]
+            # smoothed like the TCP round trip time
+            self.rtt = sample if self.rtt is None else \
+                0.875 * self.rtt + 0.125 * sample
+            return
+        m, vconn = self._find_call(src, dst)
+        if vconn is None:
+            logger.info('Link %s dropped %s from %s to %s',
+                        self.name, kind, src, dst)
+            return
+        if kind == FrameType.DATA:
+            if not m.deliver(payload):
+                m.msg_recvq.put_nowait(
+                    QueueMessage(MsgType.VConnData, payload))
+            if not m.receivable():
+                self._pause(m, vconn)
+        elif kind == FrameType.PAUSE:
+            vconn.remote_ready.clear()
+        elif kind == FrameType.RESUME:
+            vconn.remote_ready.set()
+        elif kind == FrameType.ANSWER:
+            bps, vconn.remote_modem.compression = unpack_call_info(payload)
+            vconn.set_bps(bps)
+            VirtualConnection.answer(vconn)
+        elif kind == FrameType.REFUSE:
+            VirtualConnection.set_closed(vconn)
+            vconn.dial_answered.set()
+        elif kind == FrameType.HANG:
+            self._hang_up(m, vconn)
+        else:
+            assert kind == FrameType.CANCEL
+            if vconn.status == VConnState.CONNECTING:
+                self._cancel(m, vconn)
+
+    def handle_dial(self, src, dst, bps, capable):
+        # a DIAL comes on every ring, the later ones find the call
+        m, vconn = self._find_call(src, dst)
+        if m is None or not m.activated:
+            if vconn is not None and vconn.status == VConnState.CONNECTING:
+                # the callee went away while ringing
+                self._cancel(m, vconn)
+            self.send(FrameType.REFUSE, dst, src)
+            return
+        if vconn is not None:
+            if vconn.status != VConnState.CONNECTING:
+                self.send(FrameType.REFUSE, dst, src)
+                return
+            vconn.remote_modem.bps = bps
+            vconn.remote_modem.compression = capable
+        elif m.vconn is not None:
+            # busy line
+            self.send(FrameType.REFUSE, dst, src)
+            return
+        else:
+            # a new incoming call
+            caller = phone2modem.get(src)
+            if not isinstance(caller, RemoteModem):
+                # a trunk caller, kept by the call from now on
+                caller = RemoteModem(src, src, bps, self)
+            caller.bps = bps
+            caller.compression = capable
+            m.vconn = LinkedConnection(caller, m)
+            caller.vconn = m.vconn
+            # S1: ring count of the incoming call
+            m.registers[1] = 0
+        m.msg_recvq.put_nowait(
+            QueueMessage(MsgType.VConnEvent, VConnEventType.DIAL))
+
+    def remote_in_call(self, phone):
+        '''the RemoteModem of phone in a call over this link, or None'''
+        for m in phone2modem.values():
+            vconn = m.vconn
+            if isinstance(m, RemoteModem) or \
+                    not isinstance(vconn, LinkedConnection) or \
+                    vconn.status == VConnState.CLOSED:
+                continue
+            remote = vconn.remote_modem
+            if remote.link is self and remote.phone == phone:
+                return remote
+        return None
+
+
+class LinkQueue(object):
+    '''stands in for msg_recvq of a RemoteModem, sends messages as frames'''
+
+    def __init__(self, remote_modem):
+        super().__init__()
+        self._remote_modem = remote_modem
+
+    def put_nowait(self, msg):
+        remote = self._remote_modem
+        vconn = remote.vconn
+        if vconn is None:
+            return
+        local = vconn.local_modem
+        if msg.type == MsgType.VConnData:
+            remote.link.send(FrameType.DATA, local.phone, remote.phone, msg.data)
+        elif msg.data == VConnEventType.DIAL:
+            remote.link.send(FrameType.DIAL, local.phone, remote.phone,
+                             CALL_INFO.pack(local.bps,
+                                            compression.capable(local)))
+        else:
+            assert msg.data == VConnEventType.HANG
+            remote.link.send(FrameType.HANG, local.phone, remote.phone)
+
+    async def put(self, msg):
+        self.put_nowait(msg)
+        await self._remote_modem.link.drain()
+
+
+class RemoteModem(object):
+    '''
+    a modem served by another process, takes the place of a Modem
+    on one side of a LinkedConnection
+    '''
+
+    def __init__(self, id, phone, bps, link):
+        super().__init__()
+        self.id = id
+        self.phone = phone
+        self.bps = bps
+        self.link = link
+        # checked by the process serving it
+        self.activated = True
+        self.fast_connect = False
+        # AT%C and AT\N settings, from the frames of the call
+        self.compression = False
+        self.vconn = None
+        self.msg_recvq = LinkQueue(self)
+
+    def deliver(self, data) -> bool:
+        # the data goes over the link
+        return False
+
+
+class LinkedConnection(VirtualConnection):
+    '''
+    VirtualConnection between a local modem and a RemoteModem,
+    the process on the other side keeps a mirror of it
+    '''
+
+    def __init__(self, m1, m2):
+        super().__init__(m1, m2)
+        if isinstance(m1, RemoteModem):
+            self.remote_modem, self.local_modem = m1, m2
+        else:
+            self.local_modem, self.remote_modem = m1, m2
+        # the remote modem takes data, cleared by a PAUSE frame
+        self.remote_ready = asyncio.Event()
+        self.remote_ready.set()
+        # a PAUSE was sent, RESUME follows once the local modem has room
+        self.pausing = False
+
+    def writable(self, cur_modem) -> bool:
+        return self.remote_ready.is_set() or self.closed.is_set()
+
+    async def wait_writable(self, cur_modem):
+        if self.writable(cur_modem):
+            return
+        waiters = {asyncio.ensure_future(self.remote_ready.wait()),
+                   asyncio.ensure_future(self.closed.wait())}
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waiters:
+                w.cancel()
+
+    def latency(self) -> float:
+        return self.remote_modem.link.latency()
+
+    def set_bps(self, bps):
+        if bps != self.bps:
+            self.bps = bps
+            self.speed_limiter = [SpeedLimiter(bps), SpeedLimiter(bps)]
+
+    def answer(self):
+        super().answer()
+        remote = self.remote_modem
+        remote.link.send(FrameType.ANSWER, self.local_modem.phone,
+                         remote.phone,
+                         CALL_INFO.pack(self.bps,
+                                        compression.capable(self.local_modem)))
+
+    def set_closed(self):
+        if self.status == VConnState.CONNECTING:
+            remote = self.remote_modem
+            remote.link.send(FrameType.CANCEL, self.local_modem.phone,
+                             remote.phone)
+        super().set_closed()
@@ -1,29 +1,59 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import functools
+import multiprocessing
+import signal
+import socket
 
+import capture
+import clock
 import config
-from common import CommEventType, MsgType, QueueMessage, logger, phone2modem
+import metrics
+import tcp_dial
+from capture import DIR_IN, DIR_OUT, TrafficCapture
+from common import (MsgType, QueueMessage, clear_queue, logger, phone2modem,
+                    shard_path, start_logging)
 from fake_conn_server import create_server
+from link import Link, RemoteModem
 from modem import Modem
+from trunk import run_trunks
 
+# bytes read from the COM port at once, up to queue_low_water
+# so a read overshoots the flow control by little
+READ_BUFFER_SIZE = 16 * 1024
 
-async def read_to_queue_loop(id, reader, queue):
-    while True:
-        data = await reader.read(4096)
-        logger.info(f'>{id} {data!r}')
-        if not data:
-            return
-        msg = QueueMessage(MsgType.ComData, data)
-        await queue.put(msg)
+
+def get_ready_batch(queue, batch, batch_bytes):
+    '''move items already in the queue to the batch, return its size'''
+    while batch_bytes < config.com_write_batch_bytes:
+        try:
+            data = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        batch.append(data)
+        batch_bytes += len(data)
+    return batch_bytes
 
 
-async def write_from_queue_loop(id, queue, writer):
+async def write_from_queue_loop(m, writer):
+    id = m.id
+    queue = m.com_sendq
     try:
         while True:
-            data = await queue.get()
-            logger.info(f'<{id} {data!r}')
-            writer.write(data)
+            batch = [await queue.get()]
+            batch_bytes = get_ready_batch(queue, batch, len(batch[0]))
+            if config.com_write_flush_delay > 0 and \
+                    batch_bytes < config.com_write_batch_bytes:
+                # wait a little for more small chunks
+                await asyncio.sleep(config.com_write_flush_delay)
+                batch_bytes = get_ready_batch(queue, batch, batch_bytes)
+            for data in batch:
+                logger.info('<%s %r', id, data)
+                if capture.recorder:
+                    capture.recorder.write(id, DIR_OUT, data)
+            writer.writelines(batch)
+            m.stats.com_out_bytes += batch_bytes
             await writer.drain()
     except asyncio.CancelledError:
         pass
@@ -32,44 +62,231 @@ async def write_from_queue_loop(id, queue, writer):
         await writer.wait_closed()
 
 
-def create_handler(m: Modem):
-    async def handle_read_write(reader, writer):
+class ComProtocol(asyncio.BufferedProtocol):
+    '''
+    the COM port of a modem, data from the guest is read into one
+    preallocated buffer and handed to the modem by the event loop
+    callback, without a reader task or a StreamReader in between,
+    it is also the writer of write_from_queue_loop
+    '''
+
+    def __init__(self, m):
+        super().__init__()
+        self.m = m
+        self.transport = None
+        self._buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        self._write_task = None
+        self._resume_task = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        m = self.m
+        self.transport = transport
+        if m.activated:
+            print(f'{m.id}|COM port is in use, connection refused')
+            transport.close()
+            return
         print(f'======  Modem{m.id} activated  ======')
-        assert not m.activated
-        m.activated = True
-        read_task = asyncio.create_task(
-            read_to_queue_loop(m.id, reader, m.msg_recvq))
-        write_task = asyncio.create_task(
-            write_from_queue_loop(m.id, m.com_sendq, writer))
-        await read_task
-        await m.msg_recvq.put(QueueMessage(MsgType.ComEvent, CommEventType.PortPowerOff))
-        write_task.cancel()
-        m.activated = False
-        print(f'====== Modem{m.id} deactivated ======')
-    return handle_read_write
-
-async def main():
+        m.activate()
+        m.port = self
+        if capture.recorder:
+            capture.recorder.write_open(m)
+        self._write_task = asyncio.create_task(write_from_queue_loop(m, self))
+
+    def get_buffer(self, sizehint):
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        m = self.m
+        if self._write_task is None:
+            return
+        data = bytes(self._buffer[:nbytes])
+        m.stats.com_in_bytes += nbytes
+        logger.info('>%s %r', m.id, data)
+        if capture.recorder:
+            capture.recorder.write(m.id, DIR_IN, data)
+        m.msg_recvq.put_nowait(QueueMessage(MsgType.ComData, data))
+        # stop reading while the receiver is full, like hardware flow control
+        if not m.sendable():
+            self.transport.pause_reading()
+            self._resume_task = asyncio.create_task(self._resume_reading())
+
+    async def _resume_reading(self):
+        await self.m.wait_sendable()
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        # the guest closed the port, close our side as well
+        return False
+
+    def connection_lost(self, exc):
+        m = self.m
+        if self._write_task is not None:
+            logger.info('>%s %r', m.id, b'')
+            if capture.recorder:
+                capture.recorder.write(m.id, DIR_IN, b'')
+            m.port = None
+            m.deactivate()
+            self._write_task.cancel()
+            # nobody writes the port anymore, dont block the modem on it
+            clear_queue(m.com_sendq)
+            print(f'====== Modem{m.id} deactivated ======')
+        if self._resume_task is not None:
+            self._resume_task.cancel()
+        self._writable.set()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def write_now(self, data) -> bool:
+        '''
+        write data at once, False if the guest takes no more now, or the
+        write loop holds chunks back to batch them, data would overtake
+        '''
+        if not self._writable.is_set() or self.transport.is_closing() or \
+                config.com_write_flush_delay > 0:
+            return False
+        m = self.m
+        logger.info('<%s %r', m.id, data)
+        if capture.recorder:
+            capture.recorder.write(m.id, DIR_OUT, data)
+        self.transport.write(data)
+        m.stats.com_out_bytes += len(data)
+        return True
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def writelines(self, batch):
+        self.transport.writelines(batch)
+
+    async def drain(self):
+        await self._writable.wait()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+
+async def main(shard=0, shard_socks=None):
+    '''
+    serve the modems of this shard, shard_socks connects
+    it to every other shard: {shard index: socket}
+    '''
+    capture_file = config.capture_file
+    if capture_file and config.workers > 1:
+        capture_file = shard_path(capture_file, shard)
+    if capture_file:
+        capture.recorder = TrafficCapture(capture_file)
     id = 0
     fibers = []
+    servers = []
+    links = {}
+    for peer, sock in (shard_socks or {}).items():
+        reader, writer = await asyncio.open_connection(sock=sock)
+        links[peer] = Link(f'shard{peer}', reader, writer)
+        fibers.append(links[peer].serve_forever())
     try:
         for modem_cfg in config.modems:
+            owner = id % config.workers
+            if owner != shard:
+                # served by another shard, calls go through the link
+                phone2modem[modem_cfg['phone']] = RemoteModem(
+                    id, modem_cfg['phone'], modem_cfg['bps'], links[owner])
+                id += 1
+                continue
             # create modem object
-            m = Modem(id, modem_cfg['phone'], modem_cfg['bps'])
+            m = Modem(id, modem_cfg['phone'], modem_cfg['bps'],
+                      modem_cfg.get('fast_connect', False))
             # register modem object
-            svr = await create_server(create_handler(m), modem_cfg['address'])
-            if hasattr(svr, '__aenter__'):
-                await svr.__aenter__()
-            fibers.append(svr.serve_forever())
-            fibers.append(m.main_loop())
+            svr = await create_server(
+                functools.partial(ComProtocol, m), modem_cfg['address'])
+            if isinstance(svr, asyncio.AbstractServer):
+                # accepts by itself, no task per modem
+                servers.append(svr)
+            else:
+                fibers.append(svr.serve_forever())
             phone2modem[modem_cfg['phone']] = m
             id += 1
 
+        tcp_dial.prewarm()
+        if config.trunk_listen or config.trunk_peers:
+            if config.workers > 1:
+                # a trunk may carry calls to the modems of any shard
+                print('Trunks need workers = 1, ignored')
+            else:
+                fibers.append(run_trunks())
+        if config.metrics_address:
+            host, port = config.metrics_address
+            # one port per shard
+            fibers.append(metrics.serve_metrics((host, port + shard)))
+        # run until cancelled
+        fibers.append(asyncio.get_running_loop().create_future())
         await asyncio.gather(*fibers)
     finally:
-        for f in fibers:
-            if hasattr(f, '__aexit__'):
-                await f.__aexit__()
+        for svr in servers:
+            svr.close()
+        tcp_dial.close_pools()
+        if capture.recorder:
+            capture.recorder.close()
+            capture.recorder = None
+
+
+def shard_main(shard, all_socks):
+    # sockets of the other shards are inherited too, a link only
+    # sees EOF once every copy of its peer socket is closed
+    for i, socks in enumerate(all_socks):
+        if i != shard:
+            for sock in socks.values():
+                sock.close()
+    start_logging(shard_path(config.log_file, shard))
+    try:
+        clock.run(main(shard, all_socks[shard]), config.virtual_time,
+                  config.use_uvloop)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_shards():
+    '''split the modems across config.workers processes, fully connected'''
+    shard_socks = [{} for _ in range(config.workers)]
+    for i in range(config.workers):
+        for j in range(i + 1, config.workers):
+            shard_socks[i][j], shard_socks[j][i] = socket.socketpair()
+    processes = [
+        multiprocessing.Process(target=shard_main, args=(i, shard_socks),
+                                name=f'shard{i}')
+        for i in range(config.workers)]
+    for p in processes:
+        p.start()
+
+    def terminate(signum, frame):
+        # the shards would live on without the parent and hold the ports
+        for p in processes:
+            p.terminate()
+
+    # set after the fork, so the shards keep the default action
+    signal.signal(signal.SIGTERM, terminate)
+    for socks in shard_socks:
+        for sock in socks.values():
+            sock.close()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.join()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if config.workers > 1:
+        run_shards()
+    else:
+        clock.run(main(), config.virtual_time, config.use_uvloop)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import json
+
+import clock
+from common import phone2modem
+
+
+class Histogram(object):
+    '''counts observations in cumulative buckets, like a Prometheus one'''
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the last one counts the values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''[(upper bound, count of values <= it)], the last bound is +Inf'''
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class ModemStats(object):
+    '''counters of a modem, updated on the data path'''
+    __slots__ = ('com_in_bytes', 'com_out_bytes', 'line_sent_bytes',
+                 'pacing_delay_seconds', 'calls',
+                 'call_sent_bytes', 'call_send_start', 'call_send_end')
+
+    def __init__(self):
+        self.com_in_bytes = 0
+        self.com_out_bytes = 0
+        self.line_sent_bytes = 0
+        self.pacing_delay_seconds = 0
+        self.calls = 0
+        # bytes sent into the current call, and when they were sent
+        self.call_sent_bytes = 0
+        self.call_send_start = 0
+        self.call_send_end = 0
+
+    def achieved_bps(self) -> float:
+        '''bps of the current call while it was sending'''
+        used = self.call_send_end - self.call_send_start
+        return self.call_sent_bytes * 8 / used if used > 0 else 0
+
+
+pacing_delay = Histogram(
+    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+dial_latency = Histogram(
+    (0.01, 0.1, 0.5, 1, 2, 5, 10, 15, 30, 60))
+
+
+def record_send(modem, byte_count, delay):
+    '''byte_count bytes went into the line after the SpeedLimiter delay'''
+    stats = modem.stats
+    now = clock.now()
+    if not stats.call_sent_bytes:
+        stats.call_send_start = now - delay
+    stats.call_sent_bytes += byte_count
+    stats.call_send_end = now
+    stats.line_sent_bytes += byte_count
+    stats.pacing_delay_seconds += delay
+    pacing_delay.observe(delay)
+
+
+def record_connect(modem, dial_second=None):
+    '''a call of modem is connected, dialed dial_second ago'''
+    stats = modem.stats
+    stats.calls += 1
+    stats.call_sent_bytes = 0
+    if dial_second is not None:
+        dial_latency.observe(dial_second)
+
+
+def _local_modems():
+    # RemoteModems are counted by the process serving them
+    return [m for m in phone2modem.values() if getattr(m, 'stats', None)]
+
+
+def _queue_depth(queue):
+    return (queue.nbytes, queue.qsize()) if queue else (0, 0)
+
+
+async def loop_lag() -> float:
+    '''seconds a ready callback waits for the event loop'''
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.sleep(0)
+    return loop.time() - start
+
+
+async def snapshot() -> dict:
+    '''
+    every metric at this moment, gauges are computed here
+    so nothing is spent on them until somebody scrapes
+    '''
+    modems = []
+    for m in _local_modems():
+        stats = m.stats
+        vconn = m.vconn
+        recvq_bytes, recvq_items = _queue_depth(m.msg_recvq)
+        sendq_bytes, sendq_items = _queue_depth(m.com_sendq)
+        modems.append({
+            'modem': m.id,
+            'phone': m.phone,
+            'activated': int(m.activated),
+            'com_in_bytes': stats.com_in_bytes,
+            'com_out_bytes': stats.com_out_bytes,
+            'line_sent_bytes': stats.line_sent_bytes,
+            'pacing_delay_seconds': stats.pacing_delay_seconds,
+            'calls': stats.calls,
+            'msg_recvq_bytes': recvq_bytes,
+            'msg_recvq_items': recvq_items,
+            'com_sendq_bytes': sendq_bytes,
+            'com_sendq_items': sendq_items,
+            'call_bps': vconn.bps if vconn else 0,
+            'call_achieved_bps': stats.achieved_bps() if vconn else 0,
+            'call_compression_ratio':
+                vconn.compression_ratio(m) if vconn else 0,
+        })
+    return {
+        'modems': modems,
+        'chunk_pacing_delay_seconds': pacing_delay,
+        'dial_latency_seconds': dial_latency,
+        'event_loop_lag_seconds': await loop_lag(),
+        'tasks': len(asyncio.all_tasks()),
+    }
+
+
+# (name, type, help) of the per-modem metrics
+MODEM_METRICS = (
+    ('activated', 'gauge', 'the guest has the port open'),
+    ('com_in_bytes', 'counter', 'bytes read from the guest'),
+    ('com_out_bytes', 'counter', 'bytes written to the guest'),
+    ('line_sent_bytes', 'counter', 'bytes sent to the remote'),
+    ('pacing_delay_seconds', 'counter', 'seconds the SpeedLimiter held data'),
+    ('calls', 'counter', 'calls connected'),
+    ('msg_recvq_bytes', 'gauge', 'bytes waiting for the modem'),
+    ('msg_recvq_items', 'gauge', 'messages waiting for the modem'),
+    ('com_sendq_bytes', 'gauge', 'bytes waiting for the guest'),
+    ('com_sendq_items', 'gauge', 'chunks waiting for the guest'),
+    ('call_bps', 'gauge', 'bps of the current call'),
+    ('call_achieved_bps', 'gauge', 'bps the current call achieved sending'),
+    ('call_compression_ratio', 'gauge',
+     'bytes sent per byte on the line in the current call'),
+)
+
+
+def _render_histogram(lines, name, help, histogram):
+    lines.append(f'# HELP vmodem_{name} {help}')
+    lines.append(f'# TYPE vmodem_{name} histogram')
+    for bound, count in histogram.cumulative():
+        le = '+Inf' if bound == float('inf') else bound
+        lines.append(f'vmodem_{name}_bucket{{le="{le}"}} {count}')
+    lines.append(f'vmodem_{name}_sum {histogram.sum}')
+    lines.append(f'vmodem_{name}_count {histogram.count}')
+
+
+def render_prometheus(snap) -> str:
+    lines = []
+    for name, kind, help in MODEM_METRICS:
+        suffix = '_total' if kind == 'counter' else ''
+        lines.append(f'# HELP vmodem_{name}{suffix} {help}')
+        lines.append(f'# TYPE vmodem_{name}{suffix} {kind}')
+        for m in snap['modems']:
+            lines.append(f'vmodem_{name}{suffix}{{modem="{m["modem"]}",'
+                         f'phone="{m["phone"]}"}} {m[name]}')
+    _render_histogram(lines, 'chunk_pacing_delay_seconds',
+                      'SpeedLimiter delay of each chunk sent',
+                      snap['chunk_pacing_delay_seconds'])
+    _render_histogram(lines, 'dial_latency_seconds',
+                      'seconds from ATD to CONNECT',
+                      snap['dial_latency_seconds'])
+    lines.append('# TYPE vmodem_event_loop_lag_seconds gauge')
+    lines.append(f'vmodem_event_loop_lag_seconds '
+                 f'{snap["event_loop_lag_seconds"]}')
+    lines.append('# TYPE vmodem_tasks gauge')
+    lines.append(f'vmodem_tasks {snap["tasks"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_json(snap) -> str:
+    def histogram_json(histogram):
+        return {
+            'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                        for bound, count in histogram.cumulative()],
+            'sum': histogram.sum,
+            'count': histogram.count,
+        }
+    snap = dict(snap)
+    for name in ('chunk_pacing_delay_seconds', 'dial_latency_seconds'):
+        snap[name] = histogram_json(snap[name])
+    return json.dumps(snap)
+
+
+async def handle_request(reader, writer):
+    try:
+        request = await reader.readline()
+        # the headers do not matter
+        while (await reader.readline()).strip():
+            pass
+        parts = request.split()
+        path = parts[1].decode('ascii', 'replace') if len(parts) > 1 else ''
+        if path == '/metrics':
+            status = '200 OK'
+            content_type = 'text/plain; version=0.0.4'
+            body = render_prometheus(await snapshot())
+        elif path == '/metrics.json':
+            status = '200 OK'
+            content_type = 'application/json'
+            body = render_json(await snapshot())
+        else:
+            status = '404 Not Found'
+            content_type = 'text/plain'
+            body = 'try /metrics or /metrics.json\n'
+        body = body.encode('utf-8')
+        writer.write(
+            f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(address):
+    server = await asyncio.start_server(handle_request, *address)
+    async with server:
+        await server.serve_forever()
+
@@ -3,50 +3,185 @@
 import asyncio
 import traceback
 
-from cmd_processor import dispatch_command
-from common import (CommEventType, Mode, MsgType, QueueMessage, VConnEventType,
-                    VConnState, clear_queue)
+import clock
+import config
+import metrics
+from cmd_processor import answer_call, dispatch_command
+from common import (ByteBuffer, CommEventType, FlowControlQueue, Mode, MsgType,
+                    QueueMessage, VConnEventType, clear_queue)
+from timer_wheel import wheel
+
+# S2 above this disables the escape sequence
+MAX_ESCAPE_CHAR = 127
+ESCAPE_LENGTH = 3
+
+
+# S2: escape character, '+'
+# S12: escape guard time in 1/50 second
+# S46: data compression, AT%C
+# S48: error control, AT\N, 3 for V.42 with fallback
+DEFAULT_REGISTERS = bytearray(256)
+DEFAULT_REGISTERS[2] = 43
+DEFAULT_REGISTERS[12] = 50
+DEFAULT_REGISTERS[48] = 3
 
 
 class Modem(object):
-    def __init__(self, id, phone, bps):
+    __slots__ = (
+        'id', 'phone', 'bps', 'fast_connect', 'activated', 'mode', 'vconn',
+        'registers', 'msg_recvq', 'com_sendq', 'cmd_recv_buffer',
+        'data_recv_buffer', 'bufferd_send_data', 'bufferd_send_writable',
+        'last_com_data_time', 'escape_timer', 'main_task', 'busy', 'port',
+        'stats')
+
+    def __init__(self, id, phone, bps, fast_connect=False):
         super().__init__()
         self.id = id
         self.phone = phone
         self.bps = bps
+        # skip sounds and ring faster when dialing
+        self.fast_connect = fast_connect
         self.activated = False
-        self.msg_recvq = asyncio.Queue()
-        self.com_sendq = asyncio.Queue()
+        self.mode = Mode.CMD
         self.vconn = None
+        # the rest is created when the port activates the first time,
+        # thousands of modems can be configured but never used
+        self.registers = None
+        self.msg_recvq = None
+        self.com_sendq = None
+        self.cmd_recv_buffer = None
+        self.data_recv_buffer = None
+        # buffer for data received from the remote in CMD mode
+        self.bufferd_send_data = None
+        self.bufferd_send_writable = None
+        # when the guest sent data last, for the escape guard time
+        self.last_com_data_time = 0
+        # fires one guard time after escape characters held back
+        self.escape_timer = None
+        self.main_task = None
+        # main_loop handles a message that may switch the mode
+        # or write to the guest, deliver() must not overtake it
+        self.busy = False
+        # writes to the guest at once, set while the port is open
+        self.port = None
+        self.stats = None
+
+    def activate(self):
+        '''the guest opened the port, start taking commands'''
+        if self.registers is None:
+            self.registers = bytearray(DEFAULT_REGISTERS)
+            self.msg_recvq = FlowControlQueue(
+                config.queue_high_water, config.queue_low_water)
+            self.com_sendq = FlowControlQueue(
+                config.queue_high_water, config.queue_low_water)
+            self.cmd_recv_buffer = ByteBuffer()
+            self.data_recv_buffer = ByteBuffer()
+            self.bufferd_send_data = ByteBuffer()
+            self.bufferd_send_writable = asyncio.Event()
+            self.stats = metrics.ModemStats()
+        if self.main_task and not self.main_task.done():
+            # reopened before the power off was handled
+            self.main_task.cancel()
         self.clear_status()
+        self.activated = True
+        self.main_task = asyncio.create_task(self.main_loop())
+
+    def deactivate(self):
+        '''the guest closed the port, main_loop ends after cleaning up'''
+        self.activated = False
+        self.msg_recvq.put_nowait(
+            QueueMessage(MsgType.ComEvent, CommEventType.PortPowerOff))
 
     def clear_status(self):
         self.mode = Mode.CMD
         self.clear_registers()
-        self.cmd_recv_buffer = b''
-        self.data_recv_buffer = b''
+        self.cmd_recv_buffer.clear()
+        self.clear_escape()
         clear_queue(self.msg_recvq)
         clear_queue(self.com_sendq)
-        # buffer for data received from the remote in CMD mode
-        self.bufferd_send_data = b''
+        self.take_bufferd_send_data()
         # make virtual connection half closed
         if self.vconn:
-            self.vconn.status = VConnState.CLOSED
+            self.vconn.set_closed()
         self.vconn = None
-    
+
     def clear_registers(self):
-        self.registers = [0] * 256
+        self.registers[:] = DEFAULT_REGISTERS
+
+    def guard_second(self) -> float:
+        return self.registers[12] / 50
+
+    def clear_escape(self):
+        '''drop escape characters held back'''
+        self.data_recv_buffer.clear()
+        if self.escape_timer:
+            wheel.cancel(self.escape_timer)
+            self.escape_timer = None
+
+    def _escape_timeout(self):
+        self.escape_timer = None
+        self.msg_recvq.put_nowait(
+            QueueMessage(MsgType.ComEvent, CommEventType.DataModeSeemsEnd))
+
+    def take_bufferd_send_data(self) -> bytes:
+        self.bufferd_send_writable.set()
+        return self.bufferd_send_data.take()
+
+    def receivable(self) -> bool:
+        '''if data from the remote can be taken without waiting'''
+        return self.msg_recvq.writable() and self.com_sendq.writable() and \
+            self.bufferd_send_writable.is_set()
+
+    async def wait_receivable(self):
+        while not self.receivable():
+            await self.msg_recvq.wait_writable()
+            await self.com_sendq.wait_writable()
+            await self.bufferd_send_writable.wait()
+
+    def deliver(self, data) -> bool:
+        '''
+        DATA mode fast path: data from the line goes to the guest without
+        the msg_recvq and main_loop hops when nothing is ahead of it,
+        return False if it has to go through msg_recvq
+        '''
+        if self.mode != Mode.DATA or self.busy or self.msg_recvq.qsize() \
+                or not self.com_sendq.writable():
+            return False
+        if self.com_sendq.qsize() or not self.port or \
+                not self.port.write_now(data):
+            self.com_sendq.put_nowait(data)
+        return True
+
+    def sendable(self) -> bool:
+        '''if data from the guest can be taken without waiting'''
+        return self.msg_recvq.writable() and \
+            (self.vconn is None or self.vconn.writable(self))
+
+    async def wait_sendable(self):
+        '''wait until data from the guest can be taken, like CTS'''
+        await self.msg_recvq.wait_writable()
+        if self.vconn:
+            await self.vconn.wait_writable(self)
 
     async def main_loop(self):
         while True:
             try:
                 msg = await self.msg_recvq.get()
-                await self.process_msg(msg)
+                # data from the guest in DATA mode only goes into the line
+                self.busy = msg.type != MsgType.ComData or \
+                    self.mode != Mode.DATA
+                try:
+                    await self.process_msg(msg)
+                finally:
+                    self.busy = False
             except asyncio.CancelledError:
                 return
             except BaseException:
                 print('Exception in main_loop:')
                 traceback.print_exc()
+            else:
+                if msg.data == CommEventType.PortPowerOff:
+                    return
 
     async def process_msg(self, msg):
         if self.mode == Mode.DATA:
@@ -60,36 +195,48 @@ class Modem(object):
                 assert msg.type == MsgType.VConnEvent
                 assert msg.data == VConnEventType.HANG
                 self.vconn = None
+                self.clear_escape()
                 await self.com_sendq.put(b'NO CARRIER\r')
                 self.mode = Mode.CMD
                 print(
                     f'{self.id}|Remote close connection during DATA mode')
         else:
             if msg.type == MsgType.ComData:
+                self.last_com_data_time = clock.now()
                 await self.handle_at_command(msg.data)
             elif msg.type == MsgType.VConnData:
                 # CMD mode, just buffer it
-                self.bufferd_send_data += msg.data
+                self.bufferd_send_data.append(msg.data)
+                if len(self.bufferd_send_data) >= config.queue_high_water:
+                    self.bufferd_send_writable.clear()
             elif msg.type == MsgType.ComEvent:
                 await self.handle_com_event(msg.data)
             else:
                 assert msg.type == MsgType.VConnEvent
                 if msg.data == VConnEventType.HANG:
                     self.vconn = None
+                    self.take_bufferd_send_data()
                     await self.com_sendq.put(b'NO CARRIER\r')
                     print(
                         f'{self.id}|Remote close connection during CMD mode')
                 else:
                     await self.com_sendq.put(b'RING\r')
+                    await self.handle_ring()
+
+    async def handle_ring(self):
+        # S1 counts rings, S0 answers automatically after that many rings
+        self.registers[1] = min(self.registers[1] + 1, 255)
+        if self.registers[0] and self.registers[1] >= self.registers[0]:
+            print(f'{self.id}|Auto answer after {self.registers[1]} rings')
+            await self.com_sendq.put(answer_call(self))
 
     async def handle_at_command(self, data):
-        self.cmd_recv_buffer += data
+        self.cmd_recv_buffer.append(data)
         while True:
             ri = self.cmd_recv_buffer.find(b'\r')
             if ri < 0:
                 break
-            cmd = self.cmd_recv_buffer[:ri].strip()
-            self.cmd_recv_buffer = self.cmd_recv_buffer[ri+1:]
+            cmd = self.cmd_recv_buffer.take(ri + 1)[:-1].strip()
             if not cmd:
                 continue
             res = await dispatch_command(self, cmd)
@@ -97,9 +244,8 @@ class Modem(object):
                 await self.com_sendq.put(res)
             # if transferred to data mode, check if there is a buffered data
             if self.mode == Mode.DATA and self.bufferd_send_data:
-                await self.com_sendq.put(self.bufferd_send_data)
-                self.bufferd_send_data = b''
-                self.cmd_recv_buffer = b''
+                await self.com_sendq.put(self.take_bufferd_send_data())
+                self.cmd_recv_buffer.clear()
                 break
 
     async def handle_com_event(self, data):
@@ -117,29 +263,45 @@ class Modem(object):
     async def try_end_data_mode(self):
         if not self.data_recv_buffer:
             return
-        # are still the escape sequence after one second
-        if self.data_recv_buffer == b'+++':
+        if self.escape_timer is not None:
+            # more data came after this timer fired, a newer one is on
+            # the way; now - last_com_data_time may round below the guard
+            return
+        # a complete escape sequence followed by the guard time
+        if len(self.data_recv_buffer) == ESCAPE_LENGTH:
             print(f'{self.id}|Return to CMD mode')
+            self.data_recv_buffer.clear()
             self.mode = Mode.CMD
             await self.com_sendq.put(b'OK\r')
         else:
-            await self.vconn.push_data(self, self.data_recv_buffer)
-            self.data_recv_buffer = b''
+            await self.vconn.push_data(self, self.data_recv_buffer.take())
+
+    def _is_escape(self, data, held) -> bool:
+        '''if data goes on the held back escape characters, O(1)'''
+        escape_char = self.registers[2]
+        return len(data) + held <= ESCAPE_LENGTH and \
+            escape_char <= MAX_ESCAPE_CHAR and \
+            data.count(escape_char) == len(data)
 
     async def handle_com_data(self, data):
-        self.data_recv_buffer += data
-        # b'+++': escape to command mode
-        # The escape sequence was preceded and followed by one second of silence
-        if self.data_recv_buffer in {b'+', b'++'}:
-            return
-        if self.data_recv_buffer == b'+++':
-            async def send_check_msg_asecond_later():
-                await asyncio.sleep(0.5)
-                msg = QueueMessage(
-                    MsgType.ComEvent, CommEventType.DataModeSeemsEnd)
-                await self.msg_recvq.put(msg)
-            asyncio.create_task(send_check_msg_asecond_later())
+        # the escape sequence is preceded and followed by the guard time,
+        # its characters are held back until it is complete or broken
+        now = clock.now()
+        guard_second = self.guard_second()
+        silent = now - self.last_com_data_time >= guard_second
+        self.last_com_data_time = now
+        held = len(self.data_recv_buffer)
+        if (held or silent) and self._is_escape(data, held):
+            self.data_recv_buffer.append(data)
+            if self.escape_timer:
+                wheel.cancel(self.escape_timer)
+            self.escape_timer = wheel.call_at(
+                now + guard_second, self._escape_timeout)
             return
-
-        await self.vconn.push_data(self, self.data_recv_buffer)
-        self.data_recv_buffer = b''
+        if held:
+            # not an escape sequence after all
+            if self.escape_timer:
+                wheel.cancel(self.escape_timer)
+                self.escape_timer = None
+            data = self.data_recv_buffer.take() + data
+        await self.vconn.push_data(self, data)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+
+IN_ATTRIB = 0x4
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+# a socket is bound or moved into place, or its permissions change
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+# struct inotify_event without the name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class PathWatcher(object):
+    '''
+    wakes up the tasks waiting for a socket path to appear, one inotify
+    instance watches the directories of all of them, where there is no
+    inotify the wait just sleeps
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._libc = _load_libc()
+        self._fd = None
+        self._loop = None
+        # directory: watch descriptor, and back
+        self._wds = {}
+        self._dirs = {}
+        # (watch descriptor, file name): futures waiting for it
+        self._waiters = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self._libc is not None
+
+    def enable(self):
+        '''watch with inotify again, if the platform has it'''
+        self._libc = _load_libc()
+
+    def disable(self):
+        '''sleep in wait() from now on, e.g. to compare with inotify'''
+        self._close()
+        self._libc = None
+
+    def _close(self):
+        if self._fd is not None:
+            if self._loop and not self._loop.is_closed():
+                self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+        self._fd = None
+        self._loop = None
+        self._wds.clear()
+        self._dirs.clear()
+        self._waiters.clear()
+
+    def _start(self) -> bool:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return True
+        # first wait, or a new event loop
+        self._close()
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print(f'inotify unavailable: {os.strerror(ctypes.get_errno())}')
+            self._libc = None
+            return False
+        try:
+            loop.add_reader(fd, self._read_events)
+        except NotImplementedError:
+            # the event loop cant watch a fd, e.g. the Windows proactor
+            os.close(fd)
+            self._libc = None
+            return False
+        self._fd = fd
+        self._loop = loop
+        return True
+
+    def _watch(self, dir_path):
+        '''watch descriptor of dir_path, None if it cant be watched'''
+        wd = self._wds.get(dir_path)
+        if wd is None:
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                # e.g. the directory is not there yet
+                return None
+            self._wds[dir_path] = wd
+            self._dirs[wd] = dir_path
+        return wd
+
+    def _wake(self, key):
+        for fut in self._waiters.pop(key, ()):
+            if not fut.done():
+                fut.set_result(None)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, let everybody try again
+                for key in list(self._waiters):
+                    self._wake(key)
+            elif mask & IN_IGNORED:
+                # the directory is gone, watch it again on the next wait
+                dir_path = self._dirs.pop(wd, None)
+                self._wds.pop(dir_path, None)
+                for key in [k for k in self._waiters if k[0] == wd]:
+                    self._wake(key)
+            else:
+                self._wake((wd, os.fsdecode(name)))
+
+    async def wait(self, path, timeout, missing=False) -> bool:
+        '''
+        sleep up to timeout seconds, or until path is created,
+        if it was missing and is there by now, return at once,
+        return if path was created
+        '''
+        if not self.enabled or not self._start():
+            await asyncio.sleep(timeout)
+            return False
+        dir_path, name = os.path.split(os.path.abspath(path))
+        wd = self._watch(dir_path)
+        if wd is None:
+            await asyncio.sleep(timeout)
+            return False
+        key = (wd, name)
+        fut = self._loop.create_future()
+        self._waiters.setdefault(key, set()).add(fut)
+        if missing and os.path.exists(path):
+            # created before the watch was added
+            fut.set_result(None)
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters:
+                waiters.discard(fut)
+                if not waiters:
+                    del self._waiters[key]
+
+
+# shared by all modems
+watcher = PathWatcher()
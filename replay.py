@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import sys
+import time
+
+import clock
+import config
+from capture import DIR_IN, DIR_OPEN, DIR_OUT, read_capture
+from common import MsgType, QueueMessage, phone2modem
+from modem import Modem
+
+# seconds an input waits for the output the guest saw before it
+OUTPUT_TIMEOUT_SECOND = 30
+
+
+class Progress(object):
+    '''wakes up every waiter once any modem writes to its guest'''
+
+    def __init__(self):
+        super().__init__()
+        self._event = asyncio.Event()
+
+    def notify(self):
+        event = self._event
+        self._event = asyncio.Event()
+        event.set()
+
+    async def wait(self):
+        await self._event.wait()
+
+
+class ReplayGuest(object):
+    '''
+    plays the guest of one recorded modem: writes what it wrote at the
+    same offsets from the start, but not before the modems answered what
+    it had seen by then, and collects what its modem answers
+    '''
+
+    def __init__(self, modem_id, phone, bps, fast_connect):
+        super().__init__()
+        self.modem = Modem(modem_id, phone, bps, fast_connect)
+        # (seconds from the start, data, ((guest, output bytes), ...)),
+        # data is None to open the port and b'' to close it
+        self.inputs = []
+        self.expected = bytearray()
+        self.expected_last = 0
+        self.output = bytearray()
+        self.last_output = 0
+        # inputs that gave up waiting for the output before them
+        self.stalls = 0
+
+    async def wait_outputs(self, waits, progress) -> bool:
+        deadline = clock.now() + OUTPUT_TIMEOUT_SECOND
+        while any(len(g.output) < n for g, n in waits):
+            timeout = deadline - clock.now()
+            if timeout <= 0:
+                return False
+            try:
+                await asyncio.wait_for(progress.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def feed(self, start, progress):
+        m = self.modem
+        for offset, data, waits in self.inputs:
+            if not await self.wait_outputs(waits, progress):
+                self.stalls += 1
+            delay = start + offset - clock.now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if data is None:
+                if not m.activated:
+                    m.activate()
+            elif not data:
+                m.deactivate()
+            elif m.activated:
+                await m.msg_recvq.put(QueueMessage(MsgType.ComData, data))
+
+    async def collect(self, start, progress):
+        while True:
+            if self.modem.com_sendq is None:
+                await asyncio.sleep(0.01)
+                continue
+            self.output += await self.modem.com_sendq.get()
+            self.last_output = clock.now() - start
+            progress.notify()
+
+    def first_difference(self):
+        '''offset of the first byte of output unlike the recording, or None'''
+        for i, (a, b) in enumerate(zip(self.output, self.expected)):
+            if a != b:
+                return i
+        if len(self.output) != len(self.expected):
+            return min(len(self.output), len(self.expected))
+        return None
+
+
+def load_guests(path):
+    '''{modem id: ReplayGuest} of a capture file'''
+    records = read_capture(path)
+    guests = {}
+    t0 = None
+    for ts, modem_id, direction, data in records:
+        if t0 is None:
+            t0 = ts
+        guest = guests.get(modem_id)
+        if guest is None:
+            if direction == DIR_OPEN:
+                phone, bps, fast_connect = data.decode('ascii').split()
+                info = (phone, int(bps), fast_connect == '1')
+            elif modem_id < len(config.modems):
+                # recorded after the port was opened, take the config
+                cfg = config.modems[modem_id]
+                info = (cfg['phone'], cfg['bps'],
+                        cfg.get('fast_connect', False))
+            else:
+                print(f'Modem{modem_id} is unknown, its records are skipped')
+                continue
+            guest = guests[modem_id] = ReplayGuest(modem_id, *info)
+            if direction != DIR_OPEN:
+                guest.inputs.append((0, None, ()))
+        if direction in (DIR_OPEN, DIR_IN):
+            # every guest has seen the output recorded before this
+            waits = tuple((g, len(g.expected))
+                          for g in guests.values() if g.expected)
+            if direction == DIR_OPEN:
+                data = None
+            guest.inputs.append((ts - t0, data, waits))
+        elif direction == DIR_OUT:
+            guest.expected += data
+            guest.expected_last = ts - t0
+    return guests
+
+
+async def replay(guests):
+    '''run the guests to the end, return the seconds it took'''
+    for guest in guests.values():
+        phone2modem[guest.modem.phone] = guest.modem
+    progress = Progress()
+    start = clock.now()
+    collectors = [asyncio.create_task(g.collect(start, progress))
+                  for g in guests.values()]
+    await asyncio.gather(*(g.feed(start, progress) for g in guests.values()))
+    # the answers to the last inputs are still on the way
+    waits = tuple((g, len(g.expected)) for g in guests.values())
+    for guest in guests.values():
+        await guest.wait_outputs(waits, progress)
+    end = clock.now()
+    for task in collectors:
+        task.cancel()
+    for guest in guests.values():
+        if guest.modem.main_task:
+            guest.modem.main_task.cancel()
+    return end - start
+
+
+def main():
+    '''
+    python replay.py [--realtime] log/traffic.cap
+    replays a capture into new modems, in virtual time unless
+    --realtime, so a long session takes only the CPU time it needs
+    '''
+    args = sys.argv[1:]
+    realtime = '--realtime' in args
+    paths = [a for a in args if a != '--realtime']
+    if len(paths) != 1:
+        print(main.__doc__)
+        return 2
+    guests = load_guests(paths[0])
+    if not guests:
+        print('Nothing to replay')
+        return 2
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    replayed = clock.run(replay(guests), not realtime)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    print(f'{"modem":>5} {"phone":>10} {"in bytes":>9} {"out bytes":>9} '
+          f'{"recorded":>9} {"last out(s)":>11} {"recorded(s)":>11} '
+          f'{"stalls":>6} {"first diff":>10}')
+    differ = False
+    for modem_id, guest in sorted(guests.items()):
+        in_bytes = sum(len(data) for _, data, _ in guest.inputs if data)
+        diff = guest.first_difference()
+        differ = differ or diff is not None
+        print(f'{modem_id:>5} {guest.modem.phone:>10} {in_bytes:>9} '
+              f'{len(guest.output):>9} {len(guest.expected):>9} '
+              f'{guest.last_output:>11.3f} {guest.expected_last:>11.3f} '
+              f'{guest.stalls:>6} {"-" if diff is None else diff:>10}')
+    print(f'replayed in {replayed:.3f}s, {wall:.3f}s wall, {cpu:.3f}s CPU')
+    return 1 if differ else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,49 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
-import audioop
-import math
-import queue
+import functools
+import mmap
 import struct
 import sys
-import wave
+from collections import namedtuple
 
-from common import asyncio_to_thread
+from audio_engine import BLOCK_BYTES, AudioMixer
+from tone import (BYTES_PER_SAMPLE, NUM_CHANNELS, SAMPLE_RATE, empty_wave,
+                  superposition_sine_wave)
 
 try:
-    import simpleaudio as sa
+    import sounddevice as sd
 except:
-    sa = None
-
-NUM_CHANNELS = 1
-BYTES_PER_SAMPLE = 2
-SAMPLE_RATE = 8000
-
-
-def sine_wave(freq, second, volume=0.3):
-    amplitude = ((1 << 8 * BYTES_PER_SAMPLE - 1) - 1) * volume
-    omega = 2 * math.pi * freq / SAMPLE_RATE
-    num_samples = round(second * SAMPLE_RATE)
-    l = []
-    for i in range(num_samples):
-        level = round(math.sin(omega * i) * amplitude)
-        # little endian
-        l.append(struct.pack('<h', level) * NUM_CHANNELS)
-    return b''.join(l)
-
-
-def empty_wave(second):
-    num_samples = round(second * SAMPLE_RATE)
-    return b'\0' * (BYTES_PER_SAMPLE * NUM_CHANNELS * num_samples)
-
-
-def superposition_sine_wave(freqs, second, volume=0.3):
-    assert len(freqs) > 0
-    buf = sine_wave(freqs[0], second, volume)
-    for freq in freqs[1:]:
-        buf = audioop.add(buf, sine_wave(
-            freq, second, volume), BYTES_PER_SAMPLE)
-    return buf
+    sd = None
 
 
 # DTMF: Dual-Tone Multi-Frequency
@@ -52,78 +23,161 @@ def superposition_sine_wave(freqs, second, volume=0.3):
 # 770:   4    5    6    B
 # 852:   7    8    9    C
 # 941:   *    0    #    D
-DIGIT_TONE = {
-    '1': superposition_sine_wave((697, 1209), 0.1),
-    '2': superposition_sine_wave((697, 1336), 0.1),
-    '3': superposition_sine_wave((697, 1477), 0.1),
-    'A': superposition_sine_wave((697, 1633), 0.1),
-
-    '4': superposition_sine_wave((770, 1209), 0.1),
-    '5': superposition_sine_wave((770, 1336), 0.1),
-    '6': superposition_sine_wave((770, 1477), 0.1),
-    'B': superposition_sine_wave((770, 1633), 0.1),
-
-    '7': superposition_sine_wave((852, 1209), 0.1),
-    '8': superposition_sine_wave((852, 1336), 0.1),
-    '9': superposition_sine_wave((852, 1477), 0.1),
-    'C': superposition_sine_wave((852, 1633), 0.1),
-
-    '*': superposition_sine_wave((941, 1209), 0.1),
-    '0': superposition_sine_wave((941, 1336), 0.1),
-    '#': superposition_sine_wave((941, 1477), 0.1),
-    'D': superposition_sine_wave((941, 1633), 0.1),
-
-    '-': empty_wave(0.1),
-    ' ': empty_wave(0.1),
+DIGIT_FREQS = {
+    '1': (697, 1209),
+    '2': (697, 1336),
+    '3': (697, 1477),
+    'A': (697, 1633),
+
+    '4': (770, 1209),
+    '5': (770, 1336),
+    '6': (770, 1477),
+    'B': (770, 1633),
+
+    '7': (852, 1209),
+    '8': (852, 1336),
+    '9': (852, 1477),
+    'C': (852, 1633),
+
+    '*': (941, 1209),
+    '0': (941, 1336),
+    '#': (941, 1477),
+    'D': (941, 1633),
+
+    '-': (),
+    ' ': (),
 }
-DIGIT_IDLE = empty_wave(0.05)
-RINGING_TONE = superposition_sine_wave((440, 480), 1)
+DIGIT_SECOND = 0.1
+DIGIT_IDLE_SECOND = 0.05
+RINGING_FREQS = (440, 480)
+RINGING_SECOND = 1
 RINGING_IDLE_SECOND = 2
+# rings faster and without ringing tone for fast connect modems
+FAST_RINGING_IDLE_SECOND = 1
+
+
+# tones are only rendered when first played
+@functools.lru_cache(maxsize=None)
+def digit_tone(digit):
+    freqs = DIGIT_FREQS[digit]
+    if not freqs:
+        return empty_wave(DIGIT_SECOND)
+    return superposition_sine_wave(freqs, DIGIT_SECOND)
+
+
+@functools.lru_cache(maxsize=None)
+def ringing_tone():
+    return superposition_sine_wave(RINGING_FREQS, RINGING_SECOND)
+
+
+def dial_tone(phone):
+    idle = empty_wave(DIGIT_IDLE_SECOND)
+    return idle.join([digit_tone(digit) for digit in phone]) + idle
+
+
+HANDSHAKE_SOUND_FILE = {
+    300: './sound/bell103.wav',
+    1200: './sound/v22.wav',
+    2400: './sound/v22.wav',
+    4800: './sound/v32.wav',  # TODO: may be another sound? v.27?
+    9600: './sound/v32.wav',
+    14400: './sound/v32.wav',
+    28800: './sound/v34.wav',
+    33600: './sound/v34.wav',
+    56000: './sound/v90.wav',
+}
+# handshake sounds kept mapped at once
+HANDSHAKE_CACHE_SIZE = 2
+
+WaveView = namedtuple(
+    'WaveView', ('pcm', 'num_channels', 'bytes_per_sample', 'sample_rate'))
+
+
+def map_wave_file(path) -> WaveView:
+    '''
+    memory map the PCM data of a WAV file without reading it,
+    pages are loaded by the OS when played
+    '''
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:4] != b'RIFF' or mm[8:12] != b'WAVE':
+        raise ValueError(f'{path} is not a WAV file')
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(mm):
+        chunk_id = mm[pos:pos+4]
+        size, = struct.unpack_from('<I', mm, pos + 4)
+        body = pos + 8
+        if chunk_id == b'fmt ':
+            tag, num_channels, sample_rate, _, _, bits = struct.unpack_from(
+                '<HHIIHH', mm, body)
+            if tag != 1:
+                raise ValueError(f'{path} is not PCM')
+            fmt = (num_channels, bits // 8, sample_rate)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError(f'{path} has no fmt chunk')
+            return WaveView(memoryview(mm)[body:body+size], *fmt)
+        # chunks are padded to even size
+        pos = body + size + (size & 1)
+    raise ValueError(f'{path} has no data chunk')
+
 
+@functools.lru_cache(maxsize=HANDSHAKE_CACHE_SIZE)
+def load_handshake_sound(path) -> WaveView:
+    # evicted ones unmap once the mixer is done with them
+    wv = map_wave_file(path)
+    if wv[1:] != (NUM_CHANNELS, BYTES_PER_SAMPLE, SAMPLE_RATE):
+        raise ValueError(f'{path} format {wv[1:]} is not supported')
+    return wv
 
-if sa:
-    def play_sound_blocked(wo: sa.WaveObject):
-        p = wo.play()
-        p.wait_done()
+
+if sd:
+    class StreamOutput(object):
+        '''
+        one output stream kept open, opened by the first write,
+        write() blocks while the buffer of the stream is full
+        '''
+
+        def __init__(self):
+            super().__init__()
+            self._stream = None
+            self.latency = 0
+
+        def write(self, pcm):
+            if self._stream is None:
+                self._stream = sd.RawOutputStream(
+                    samplerate=SAMPLE_RATE, channels=NUM_CHANNELS,
+                    dtype=f'int{BYTES_PER_SAMPLE * 8}',
+                    blocksize=BLOCK_BYTES // (BYTES_PER_SAMPLE * NUM_CHANNELS))
+                self._stream.start()
+                self.latency = self._stream.latency
+            self._stream.write(pcm)
+
+    # started on the first sound, shared by every modem
+    mixer = AudioMixer(StreamOutput())
+
+    async def play_sound(pcm):
+        stream = mixer.submit(pcm)
+        try:
+            await stream.wait()
+        finally:
+            # stop the sound if the caller is cancelled
+            stream.cancel()
 
     async def play_dial_tone(phone):
-        global DIGIT_IDLE, DIGIT_TONE
-        buffer = DIGIT_IDLE.join([DIGIT_TONE[digit]
-                                  for digit in phone]) + DIGIT_IDLE
-        wo = sa.WaveObject(buffer, NUM_CHANNELS, BYTES_PER_SAMPLE, SAMPLE_RATE)
-        await asyncio_to_thread(play_sound_blocked, wo)
+        await play_sound(dial_tone(phone))
 
     async def play_ringing_tone():
-        global RINGING_TONE
-        buffer = RINGING_TONE
-        wo = sa.WaveObject(buffer, NUM_CHANNELS, BYTES_PER_SAMPLE, SAMPLE_RATE)
-        await asyncio_to_thread(play_sound_blocked, wo)
-
-    BELL103_SOUND = sa.WaveObject.from_wave_file('./sound/bell103.wav')
-    V22_SOUND = sa.WaveObject.from_wave_file('./sound/v22.wav')
-    V32_SOUND = sa.WaveObject.from_wave_file('./sound/v32.wav')
-    V34_SOUND = sa.WaveObject.from_wave_file('./sound/v34.wav')
-    V90_SOUND = sa.WaveObject.from_wave_file('./sound/v90.wav')
-    HANDSHAKE_SOUND = {
-        300: BELL103_SOUND,
-        1200: V22_SOUND,
-        2400: V22_SOUND,
-        4800: V32_SOUND,  # TODO: may be another sound? v.27?
-        9600: V32_SOUND,
-        14400: V32_SOUND,
-        28800: V34_SOUND,
-        33600: V34_SOUND,
-        56000: V90_SOUND,
-    }
+        await play_sound(ringing_tone())
 
     async def play_handshake_sound(bps):
-        global HANDSHAKE_SOUND
         try:
-            wo = HANDSHAKE_SOUND[bps]
+            path = HANDSHAKE_SOUND_FILE[bps]
         except KeyError:
             print(f'Handshake sound not found, unknown bps:{bps}')
         else:
-            await asyncio_to_thread(play_sound_blocked, wo)
+            await play_sound(load_handshake_sound(path).pcm)
 
 else:
     def _empty_func(*args, **kw):
@@ -137,6 +191,55 @@ else:
     play_handshake_sound = _empty_await_func
 
 
+class CallSound(object):
+    '''
+    the sounds of one call, played in turn, in the background they
+    follow the call progress without holding it up, and cancel()
+    stops the ones left when the call is answered or hung up
+    '''
+
+    def __init__(self, background):
+        super().__init__()
+        self.background = background
+        # (play_func, task) of the sounds scheduled
+        self._tasks = []
+
+    async def play(self, play_func, *args):
+        '''play after the sounds before, return at once in the background'''
+        if not self.background:
+            await play_func(*args)
+            return
+        self._tasks = [(func, task) for func, task in self._tasks
+                       if not task.done()]
+        prev = self._tasks[-1][1] if self._tasks else None
+        self._tasks.append((play_func, asyncio.create_task(
+            self._play_after(prev, play_func, args))))
+
+    async def _play_after(self, prev, play_func, args):
+        if prev:
+            await asyncio.wait((prev,))
+        await play_func(*args)
+
+    def cancel(self, play_func=None):
+        '''stop the sounds of play_func, or all of them'''
+        kept = []
+        for func, task in self._tasks:
+            if play_func is None or func is play_func:
+                task.cancel()
+            else:
+                kept.append((func, task))
+        self._tasks = kept
+
+    def stop_on(self, closed):
+        '''cancel the sounds once the closed event is set, on hang up'''
+        if self.background:
+            asyncio.create_task(self._cancel_on(closed))
+
+    async def _cancel_on(self, closed):
+        await closed.wait()
+        self.cancel()
+
+
 async def main():
     for arg in sys.argv[1:]:
         await play_dial_tone(arg)
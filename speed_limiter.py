@@ -1,18 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import bisect
+import itertools
 import random
-from datetime import datetime
+
+import clock
+import config
 
 
 class SpeedLimiter(object):
-    def __init__(self, bps):
+    def __init__(self, bps, slice_ms=None):
         '''
         init speed limit window, structure:
-        current second: [bytes left on 0ms, bytes left on 1ms, ... 999ms]
+        current second: [bytes allowed on 0ms, bytes allowed on 1ms, ... 999ms]
         '''
         super().__init__()
-        self.ts = int(datetime.now().timestamp())
         byte_ps = round(bps / 8)
         normal_window_bytes = int(byte_ps / 1000)
         expanded_window_bytes = normal_window_bytes + 1
@@ -21,28 +24,69 @@ class SpeedLimiter(object):
         self.window_tmpl = [normal_window_bytes] * normal_window_num + \
             [expanded_window_bytes] * expanded_window_num
         random.shuffle(self.window_tmpl)
-        self.bytes_left = self.window_tmpl.copy()
+        self.byte_ps = sum(self.window_tmpl)
+        # bytes allowed from the beginning of a second to the end of each ms
+        self.window_acc = list(itertools.accumulate(self.window_tmpl))
+        # the link is busy until this many bytes have been sent since epoch
+        self.busy_until = 0
+        if slice_ms is None:
+            slice_ms = config.pacing_slice_ms
+        # bytes delivered at once by pace(), 0 for the whole chunk
+        self.slice_bytes = max(1, self.byte_ps * slice_ms // 1000) \
+            if slice_ms else 0
 
-    def try_reduce_window_at(self, tms, byte_count):
-        ts = int(tms / 1000)
-        if self.ts != ts:
-            self.ts = ts
-            self.bytes_left = self.window_tmpl.copy()
-        ms = tms - ts * 1000
-        self.bytes_left[ms] -= byte_count
-        if self.bytes_left[ms] < 0:
-            left_byte = -self.bytes_left[ms]
-            self.bytes_left[ms] = 0
-            return left_byte
-        return 0
+    def bytes_before(self, tms):
+        '''bytes allowed since epoch until the beginning of the ms'''
+        ts, ms = divmod(tms, 1000)
+        total = ts * self.byte_ps
+        if ms:
+            total += self.window_acc[ms - 1]
+        return total
+
+    def reserve(self, tms, byte_count, late_bytes=0):
+        '''
+        reserve the link for byte_count bytes from tms,
+        return the ms when the last byte will be sent,
+        a sender at most late_bytes behind busy_until is still
+        sending continuously, it was only woken up late
+        '''
+        start = self.bytes_before(tms)
+        if start - late_bytes <= self.busy_until:
+            start = self.busy_until
+        self.busy_until = start + byte_count
+        ts, left = divmod(self.busy_until - 1, self.byte_ps)
+        return ts * 1000 + bisect.bisect_right(self.window_acc, left)
 
-    async def simulate_send_delay(self, byte_count):
-        tms = int(datetime.now().timestamp() * 1000)
-        sleep_to_tms = tms - 1
-        while byte_count > 0:
-            sleep_to_tms += 1
-            byte_count = self.try_reduce_window_at(sleep_to_tms, byte_count)
+    async def simulate_send_delay(self, byte_count, latency=0) -> float:
+        '''
+        wait until the last byte is sent, less the latency
+        the data still has to spend on the way to the remote,
+        return the seconds waited
+        '''
+        if byte_count <= 0:
+            return 0
+        tms = int(clock.now() * 1000)
+        sleep_to_tms = self.reserve(tms, byte_count, self.slice_bytes)
         if sleep_to_tms > tms:
-            sleep_time = sleep_to_tms / 1000 - datetime.now().timestamp()
+            sleep_time = sleep_to_tms / 1000 - latency - clock.now()
             if sleep_time > 0:
                 await asyncio.sleep(sleep_time)
+                return sleep_time
+        return 0
+
+    async def pace(self, data, latency=0, compressor=None):
+        '''
+        yield (piece, seconds waited) for slices of data, each once
+        its last byte is sent, so the remote sees a steady stream
+        like a serial line instead of a late burst of the whole chunk,
+        a compressor charges the line for the compressed bytes only
+        '''
+        end = len(data)
+        step = self.slice_bytes or end
+        for i in range(0, end, step):
+            piece = data[i:i + step] if step < end else data
+            if compressor is None:
+                byte_count = len(piece)
+            else:
+                byte_count = compressor.compress_size(piece, i + step >= end)
+            yield piece, await self.simulate_send_delay(byte_count, latency)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import socket
+
+import capture
+import clock
+import compression
+import config
+import metrics
+from common import MsgType, QueueMessage, VConnEventType, VConnState
+from speed_limiter import SpeedLimiter
+
+
+class TcpConnection(object):
+    '''
+    a call to a TCP service instead of another modem, it works like
+    a VirtualConnection so +++ and ATH behave the same
+    '''
+
+    def __init__(self, modem, reader, writer):
+        super().__init__()
+        self.modems = (modem,)
+        self.modem = modem
+        self.status = VConnState.CONNECTED
+        self.bps = modem.bps
+        # to the service, to the modem
+        self.speed_limiter = [SpeedLimiter(self.bps), SpeedLimiter(self.bps)]
+        # the modem of the service is taken to compress whenever ours does
+        self.compressor = [None, None]
+        if compression.negotiate(self.modems):
+            self.compressor = [compression.Compressor(),
+                               compression.Compressor()]
+        self.closed = asyncio.Event()
+        self._reader = reader
+        self._writer = writer
+        writer.transport.set_write_buffer_limits(
+            config.queue_high_water, config.queue_low_water)
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        # about 0.1 second of data at a time, paced like the modem line
+        chunk_size = max(1, self.bps // 80)
+        limiter = self.speed_limiter[1]
+        try:
+            while not self.closed.is_set():
+                data = await self._reader.read(chunk_size)
+                if not data:
+                    break
+                async for piece, delay in limiter.pace(
+                        data, compressor=self.compressor[1]):
+                    await self.modem.wait_receivable()
+                    if self.closed.is_set():
+                        return
+                    if not self.modem.deliver(piece):
+                        self.modem.msg_recvq.put_nowait(
+                            QueueMessage(MsgType.VConnData, piece))
+        except ConnectionError as e:
+            print(f'{self.modem.id}|TCP connection lost: {e}')
+        finally:
+            if self.status != VConnState.CLOSED:
+                # closed by the service
+                self.set_closed()
+                self.modem.msg_recvq.put_nowait(
+                    QueueMessage(MsgType.VConnEvent, VConnEventType.HANG))
+
+    async def push_data(self, cur_modem, data):
+        '''push data to the service'''
+        if not data:
+            return
+        async for piece, delay in self.speed_limiter[0].pace(
+                data, compressor=self.compressor[0]):
+            metrics.record_send(cur_modem, len(piece), delay)
+            if self.closed.is_set():
+                return
+            if capture.recorder:
+                capture.recorder.write(cur_modem.id, capture.DIR_LINE, piece)
+            self._writer.write(piece)
+
+    def compression_ratio(self, cur_modem) -> float:
+        compressor = self.compressor[0]
+        return compressor.ratio() if compressor else 1
+
+    def writable(self, cur_modem) -> bool:
+        '''if the service takes data without waiting, or the line is closed'''
+        transport = self._writer.transport
+        return transport.is_closing() or \
+            transport.get_write_buffer_size() < config.queue_high_water
+
+    async def wait_writable(self, cur_modem):
+        '''wait until the service takes data, or the line is closed'''
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    def answer(self):
+        # the call is connected as soon as it is dialed
+        return
+
+    def set_closed(self):
+        self.status = VConnState.CLOSED
+        self.closed.set()
+        self._writer.close()
+
+    async def close(self, cur_modem):
+        print(f'{cur_modem.id}|Hang up the TCP connection')
+        self.set_closed()
+        cur_modem.vconn = None
+
+
+# (host, port): (expire time, address to connect)
+_dns_cache = {}
+
+
+async def resolve(host, port):
+    '''getaddrinfo, cached for config.dns_cache_second'''
+    key = (host, port)
+    entry = _dns_cache.get(key)
+    if entry and entry[0] > clock.now():
+        return entry[1]
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        host, port, type=socket.SOCK_STREAM)
+    address = infos[0][4][:2]
+    now = clock.now()
+    # a miss is rare, every host dialed once would stay otherwise
+    for expired in [k for k, (expire, _) in _dns_cache.items()
+                    if expire <= now]:
+        del _dns_cache[expired]
+    _dns_cache[key] = (now + config.dns_cache_second, address)
+    return address
+
+
+class TcpPool(object):
+    '''connections to one endpoint opened ahead of the calls'''
+
+    def __init__(self, host, port):
+        super().__init__()
+        self.host = host
+        self.port = port
+        # (expire timer, reader, writer)
+        self.idle = collections.deque()
+        self._filling = False
+
+    async def _open(self):
+        host, port = await resolve(self.host, self.port)
+        return await asyncio.open_connection(host, port)
+
+    async def open(self):
+        '''connect, TimeoutError after config.tcp_connect_timeout_second'''
+        try:
+            return await asyncio.wait_for(
+                self._open(), config.tcp_connect_timeout_second)
+        except asyncio.TimeoutError:
+            # an OSError, unlike asyncio.TimeoutError before Python 3.11
+            raise TimeoutError('connect timed out') from None
+
+    def fill(self):
+        '''open connections in the background up to config.tcp_pool_size'''
+        if not self._filling and len(self.idle) < config.tcp_pool_size:
+            self._filling = True
+            asyncio.create_task(self._fill())
+
+    async def _fill(self):
+        try:
+            while len(self.idle) < config.tcp_pool_size:
+                reader, writer = await self.open()
+                # not kept open for good if no call comes, a loop timer
+                # as the wheel would wake up every tick until it fires
+                timer = asyncio.get_running_loop().call_later(
+                    config.tcp_pool_idle_second, self._expire, writer)
+                self.idle.append((timer, reader, writer))
+        except OSError as e:
+            print(f'Cant open connection to {self.host}:{self.port}: {e}')
+        finally:
+            self._filling = False
+            self._forget_if_empty()
+
+    def _expire(self, writer):
+        for entry in self.idle:
+            if entry[2] is writer:
+                self.idle.remove(entry)
+                break
+        writer.close()
+        self._forget_if_empty()
+
+    def _forget_if_empty(self):
+        '''drop the pool from pools once it holds nothing'''
+        endpoint = (self.host, self.port)
+        if not self.idle and not self._filling and \
+                pools.get(endpoint) is self:
+            del pools[endpoint]
+
+    async def take(self):
+        '''a connected (reader, writer), from the pool if one is alive'''
+        while self.idle:
+            timer, reader, writer = self.idle.popleft()
+            timer.cancel()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            break
+        else:
+            try:
+                reader, writer = await self.open()
+            except OSError:
+                self._forget_if_empty()
+                raise
+        self.fill()
+        self._forget_if_empty()
+        return reader, writer
+
+
+# (host, port): TcpPool
+pools = {}
+
+
+def get_pool(endpoint) -> TcpPool:
+    pool = pools.get(endpoint)
+    if pool is None:
+        pool = pools[endpoint] = TcpPool(*endpoint)
+    return pool
+
+
+def close_pools():
+    for pool in pools.values():
+        while pool.idle:
+            timer, reader, writer = pool.idle.popleft()
+            timer.cancel()
+            writer.close()
+    pools.clear()
+
+
+def parse_endpoint(phone):
+    '''(host, port) dialed by ATDT, None if phone is a modem number'''
+    if phone in config.dial_aliases:
+        host, port = config.dial_aliases[phone]
+        return host, port
+    host, sep, port = phone.rpartition(':')
+    if not sep or not host or not port.isdigit():
+        return None
+    # ATDT[::1]:23
+    return host.strip('[]').lower(), int(port)
+
+
+def dial_allowed(phone, endpoint) -> bool:
+    '''
+    if ATDT phone may connect to endpoint, the aliases always can,
+    host:port only if config.tcp_dial_allow lists it
+    '''
+    if phone in config.dial_aliases:
+        return True
+    host, port = endpoint
+    for allowed_host, allowed_port in config.tcp_dial_allow:
+        if allowed_port == port and \
+                allowed_host.lower() in ('*', host):
+            return True
+    return False
+
+
+def prewarm():
+    '''fill the pools of the aliased endpoints, before the first call'''
+    for phone in config.dial_aliases:
+        get_pool(parse_endpoint(phone)).fill()
+
+
+async def connect(modem, endpoint) -> TcpConnection:
+    reader, writer = await get_pool(endpoint).take()
+    return TcpConnection(modem, reader, writer)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import math
+
+import clock
+
+# 1/50 second, the unit of the S12 guard time
+TICK_SECOND = 0.02
+SLOT_NUM = 256
+
+
+class Timer(object):
+    __slots__ = ('tick', 'callback')
+
+    def __init__(self, tick, callback):
+        self.tick = tick
+        self.callback = callback
+
+
+class TimerWheel(object):
+    '''
+    coarse timers of every modem run by one scheduler task,
+    adding or cancelling a timer is O(1), a timer fires on the
+    first tick at or after its time
+    '''
+
+    def __init__(self, tick_second=TICK_SECOND, slot_num=SLOT_NUM):
+        super().__init__()
+        self.tick_second = tick_second
+        # timers of tick n are in slots[n % slot_num], a dict as an ordered set
+        self.slots = [{} for _ in range(slot_num)]
+        self.timer_num = 0
+        # the last tick fired
+        self._tick = None
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._task.done():
+            return
+        # first timer, or a new event loop
+        for slot in self.slots:
+            slot.clear()
+        self.timer_num = 0
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def call_at(self, when, callback) -> Timer:
+        '''call callback() at clock.now() == when'''
+        self._start()
+        tick = math.ceil(when / self.tick_second)
+        if tick * self.tick_second < when:
+            # float rounding, the tick must not come before when
+            tick += 1
+        timer = Timer(tick, callback)
+        if not self.timer_num:
+            # the wheel was idle, it goes on from the current tick
+            self._tick = min(math.floor(clock.now() / self.tick_second),
+                             timer.tick - 1)
+        elif timer.tick <= self._tick:
+            timer.tick = self._tick + 1
+        self.slots[timer.tick % len(self.slots)][timer] = None
+        self.timer_num += 1
+        self._wakeup.set()
+        return timer
+
+    def call_later(self, delay, callback) -> Timer:
+        return self.call_at(clock.now() + delay, callback)
+
+    def cancel(self, timer):
+        slot = self.slots[timer.tick % len(self.slots)]
+        if slot.pop(timer, 0) is None:
+            self.timer_num -= 1
+
+    def _fire(self, tick):
+        slot = self.slots[tick % len(self.slots)]
+        # timers a whole turn or more ahead stay in the slot
+        due = [timer for timer in slot if timer.tick <= tick]
+        for timer in due:
+            del slot[timer]
+            self.timer_num -= 1
+            try:
+                timer.callback()
+            except BaseException as e:
+                print(f'Timer callback failed: {e!r}')
+
+    async def _run(self):
+        while True:
+            if not self.timer_num:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = (self._tick + 1) * self.tick_second - clock.now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # the time of a tick may divide to a hair below it
+            now_tick = math.floor(clock.now() / self.tick_second + 1e-9)
+            while self._tick < now_tick and self.timer_num:
+                self._tick += 1
+                self._fire(self._tick)
+            self._tick = max(self._tick, now_tick)
+
+
+# shared by all modems
+wheel = TimerWheel()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import array
+import hashlib
+import math
+import os
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NUM_CHANNELS = 1
+BYTES_PER_SAMPLE = 2
+# same as the handshake sounds, so the mixer can add them up as they are
+SAMPLE_RATE = 44100
+MAX_LEVEL = (1 << 8 * BYTES_PER_SAMPLE - 1) - 1
+CACHE_DIR = './sound/cache'
+
+
+def _sine_samples(freqs, num_samples, amplitude):
+    '''sum of sine waves as 16-bit samples, clipped like audioop.add'''
+    if np is not None:
+        t = np.arange(num_samples, dtype=np.float64)
+        level = np.zeros(num_samples, dtype=np.float64)
+        for freq in freqs:
+            level += np.sin(2 * np.pi * freq / SAMPLE_RATE * t)
+        level = np.clip(np.round(level * amplitude), -MAX_LEVEL - 1, MAX_LEVEL)
+        return level.astype('<i2').tobytes()
+    omegas = [2 * math.pi * freq / SAMPLE_RATE for freq in freqs]
+    sin = math.sin
+    samples = array.array('h', [
+        max(-MAX_LEVEL - 1, min(MAX_LEVEL, round(
+            sum(sin(omega * i) for omega in omegas) * amplitude)))
+        for i in range(num_samples)])
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def _cache_path(freqs, second, volume):
+    key = f'{SAMPLE_RATE}|{BYTES_PER_SAMPLE}|{NUM_CHANNELS}|' \
+        f'{sorted(freqs)}|{second}|{volume}'
+    digest = hashlib.sha1(key.encode('ascii')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f'tone-{digest}.pcm')
+
+
+def superposition_sine_wave(freqs, second, volume=0.3):
+    '''
+    PCM of the sum of sine waves, rendered once and
+    then read back from the on-disk cache
+    '''
+    assert len(freqs) > 0
+    path = _cache_path(freqs, second, volume)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+    buf = _sine_samples(freqs, round(second * SAMPLE_RATE),
+                        MAX_LEVEL * volume)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(buf)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Cant cache tone {path}: {e}')
+    return buf
+
+
+def sine_wave(freq, second, volume=0.3):
+    return superposition_sine_wave((freq,), second, volume)
+
+
+def empty_wave(second):
+    num_samples = round(second * SAMPLE_RATE)
+    return b'\0' * (BYTES_PER_SAMPLE * NUM_CHANNELS * num_samples)
+
+
+def mix_pcm(buffers) -> bytes:
+    '''add up PCM buffers of the same length, clipped like audioop.add'''
+    if len(buffers) == 1:
+        return bytes(buffers[0])
+    if np is not None:
+        level = np.zeros(len(buffers[0]) // BYTES_PER_SAMPLE, dtype=np.int32)
+        for buf in buffers:
+            level += np.frombuffer(buf, dtype='<i2')
+        return np.clip(level, -MAX_LEVEL - 1, MAX_LEVEL).astype('<i2').tobytes()
+    samples = [array.array('h', bytes(buf)) for buf in buffers]
+    if sys.byteorder != 'little':
+        for s in samples:
+            s.byteswap()
+    level = array.array('h', [
+        max(-MAX_LEVEL - 1, min(MAX_LEVEL, sum(x)))
+        for x in zip(*samples)])
+    if sys.byteorder != 'little':
+        level.byteswap()
+    return level.tobytes()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import ipaddress
+import socket
+
+import clock
+import config
+from common import support_bps
+from link import Link, RemoteModem
+
+# seconds between PINGs on a trunk, measuring its round trip time
+PING_INTERVAL = 5
+# a trunk that has been silent for this many PINGs is dead
+PING_LOST_LIMIT = 3
+# seconds to wait before connecting to a peer again
+RETRY_SECOND = 5
+
+
+class TrunkPeer(object):
+    '''another VirtualModem instance, serving the numbers with prefixes'''
+
+    def __init__(self, address, prefixes):
+        super().__init__()
+        self.address = tuple(address)
+        self.prefixes = tuple(prefixes)
+        # the persistent connection, None while it is down
+        self.link = None
+
+    @property
+    def name(self):
+        return f'trunk {self.address[0]}:{self.address[1]}'
+
+    async def connect_forever(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*self.address)
+            except OSError as e:
+                print(f'Cant connect {self.name}: {e}')
+            else:
+                print(f'====== {self.name} connected ======')
+                self.link = Link(self.name, reader, writer)
+                try:
+                    await serve_trunk(self.link)
+                finally:
+                    self.link = None
+            await asyncio.sleep(RETRY_SECOND)
+
+
+peers = [TrunkPeer(p['address'], p['prefixes']) for p in config.trunk_peers]
+
+
+def route_phone(phone):
+    '''
+    a RemoteModem for phone on the peer with the longest matching
+    prefix, None if no connected peer serves it
+    '''
+    best = None
+    best_len = -1
+    for peer in peers:
+        if peer.link is None:
+            continue
+        for prefix in peer.prefixes:
+            if len(prefix) > best_len and phone.startswith(prefix):
+                best, best_len = peer, len(prefix)
+    if best is None:
+        return None
+    # busy while a local modem is in a call with it
+    remote = best.link.remote_in_call(phone)
+    if remote is not None:
+        return remote
+    # the real bps comes with the ANSWER
+    return RemoteModem(phone, phone, max(support_bps), best.link)
+
+
+async def ping_forever(link):
+    interval = PING_INTERVAL
+    while not link.closed:
+        if clock.now() - link.last_heard > interval * PING_LOST_LIMIT:
+            print(f'{link.name} timed out')
+            link.close()
+            return
+        link.ping()
+        await asyncio.sleep(interval)
+
+
+async def serve_trunk(link):
+    pinger = asyncio.create_task(ping_forever(link))
+    try:
+        await link.serve_forever()
+    finally:
+        pinger.cancel()
+
+
+def normalize_host(host):
+    '''an ip_address to compare, an IPv4-mapped IPv6 one as IPv4'''
+    ip = ipaddress.ip_address(host.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        return ip.ipv4_mapped
+    return ip
+
+
+async def peer_hosts():
+    '''the addresses of the peers, resolved now as they may change'''
+    loop = asyncio.get_running_loop()
+    hosts = set()
+    for peer in peers:
+        try:
+            infos = await loop.getaddrinfo(
+                peer.address[0], None, type=socket.SOCK_STREAM)
+        except OSError as e:
+            print(f'Cant resolve {peer.name}: {e}')
+            continue
+        hosts.update(normalize_host(info[4][0]) for info in infos)
+    return hosts
+
+
+async def handle_incoming(reader, writer):
+    host, port = writer.get_extra_info('peername')[:2]
+    # anyone else could place calls and flood the modems
+    if normalize_host(host) not in await peer_hosts():
+        print(f'Trunk from {host}:{port} refused, not in trunk_peers')
+        writer.close()
+        return
+    print(f'====== trunk from {host}:{port} connected ======')
+    await serve_trunk(Link(f'trunk from {host}:{port}', reader, writer))
+
+
+async def run_trunks():
+    '''accept calls on config.trunk_listen, keep connected to the peers'''
+    fibers = [peer.connect_forever() for peer in peers]
+    if config.trunk_listen:
+        server = await asyncio.start_server(
+            handle_incoming, *config.trunk_listen)
+        fibers.append(server.serve_forever())
+    await asyncio.gather(*fibers)
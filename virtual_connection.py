@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 import asyncio
 
+import capture
+import compression
+import metrics
 import sound
 from common import MsgType, QueueMessage, VConnEventType, VConnState
 from speed_limiter import SpeedLimiter
@@ -14,32 +17,82 @@ class VirtualConnection(object):
         self.status = VConnState.CONNECTING
         self.bps = min(m1.bps, m2.bps)
         self.speed_limiter = [SpeedLimiter(self.bps), SpeedLimiter(self.bps)]
+        # of the data going to modems[i], negotiated on answer
+        self.compressor = [None, None]
         self.dial_answered = asyncio.Event()
+        self.closed = asyncio.Event()
 
     def _get_remote_modem_index(self, cur_modem):
         for i in range(len(self.modems)):
             if self.modems[i].id != cur_modem.id:
                 return i
 
+    def latency(self) -> float:
+        '''seconds data takes to reach the remote modem once pushed'''
+        return 0
+
+    def compression_ratio(self, cur_modem) -> float:
+        '''raw bytes per line byte of the data cur_modem sends'''
+        compressor = self.compressor[self._get_remote_modem_index(cur_modem)]
+        return compressor.ratio() if compressor else 1
+
     async def push_data(self, cur_modem, data):
         '''push data to remote modem'''
         if not data:
             return
         ri = self._get_remote_modem_index(cur_modem)
-        await self.speed_limiter[ri].simulate_send_delay(len(data))
-        msg = QueueMessage(MsgType.VConnData, data)
-        await self.modems[ri].msg_recvq.put(msg)
-        return
+        remote = self.modems[ri]
+        async for piece, delay in self.speed_limiter[ri].pace(
+                data, self.latency(), self.compressor[ri]):
+            metrics.record_send(cur_modem, len(piece), delay)
+            if self.status == VConnState.CLOSED:
+                # nobody takes it, the remote may be powered off
+                return
+            if capture.recorder:
+                capture.recorder.write(cur_modem.id, capture.DIR_LINE, piece)
+            if not remote.deliver(piece):
+                # never blocks, the guest waits in wait_writable before sending
+                remote.msg_recvq.put_nowait(
+                    QueueMessage(MsgType.VConnData, piece))
 
-    async def dial(self, cur_modem) -> bool:
+    def writable(self, cur_modem) -> bool:
+        '''if the remote modem can take data, or the line is closed'''
+        remote = self.modems[self._get_remote_modem_index(cur_modem)]
+        return remote.receivable() or self.closed.is_set()
+
+    async def wait_writable(self, cur_modem):
+        '''wait until the remote modem can take data, or the line is closed'''
+        if self.writable(cur_modem):
+            return
+        remote = self.modems[self._get_remote_modem_index(cur_modem)]
+        waiters = {asyncio.ensure_future(remote.wait_receivable()),
+                   asyncio.ensure_future(self.closed.wait())}
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waiters:
+                w.cancel()
+
+    async def dial(self, cur_modem, sounds=None) -> bool:
+        '''ring the remote modem, sounds plays the ringing tone'''
         ri = self._get_remote_modem_index(cur_modem)
+        if sounds is None:
+            sounds = sound.CallSound(False)
+        if cur_modem.fast_connect:
+            ring_idle_second = sound.FAST_RINGING_IDLE_SECOND
+        else:
+            ring_idle_second = sound.RINGING_IDLE_SECOND
+            if sounds.background:
+                # the ringing tone plays while waiting for the answer
+                ring_idle_second += sound.RINGING_SECOND
         for times in range(5):
             # send RING message every 3 second
             msg = QueueMessage(MsgType.VConnEvent, VConnEventType.DIAL)
-            await self.modems[ri].msg_recvq.put(msg)
-            await sound.play_ringing_tone()
+            self.modems[ri].msg_recvq.put_nowait(msg)
+            if not cur_modem.fast_connect:
+                await sounds.play(sound.play_ringing_tone)
             try:
-                await asyncio.wait_for(self.dial_answered.wait(), sound.RINGING_IDLE_SECOND)
+                await asyncio.wait_for(self.dial_answered.wait(), ring_idle_second)
                 return self.status == VConnState.CONNECTED
             except asyncio.TimeoutError:
                 print(
@@ -49,16 +102,24 @@ class VirtualConnection(object):
         raise TimeoutError()
 
     def answer(self):
+        if compression.negotiate(self.modems):
+            self.compressor = [compression.Compressor(),
+                               compression.Compressor()]
         self.status = VConnState.CONNECTED
         self.dial_answered.set()
         return
 
+    def set_closed(self):
+        self.status = VConnState.CLOSED
+        # wake up the guests waiting to send
+        self.closed.set()
+
     async def close(self, cur_modem):
         print(
             f'{cur_modem.id}|Hang up the connection from modem{self.modems[0].id} to modem{self.modems[1].id}')
         ri = self._get_remote_modem_index(cur_modem)
-        self.status = VConnState.CLOSED
+        self.set_closed()
         msg = QueueMessage(MsgType.VConnEvent, VConnEventType.HANG)
-        await self.modems[ri].msg_recvq.put(msg)
+        self.modems[ri].msg_recvq.put_nowait(msg)
         for m in self.modems:
             m.vconn = None